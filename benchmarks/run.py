@@ -0,0 +1,151 @@
+"""Drive the book, weread and read_time entry points against the local stubs
+
+    python benchmarks/run.py --books 2000 --highlights 200000 --latency 0.05
+
+The first run syncs into an empty workspace, later runs (--runs) are incremental.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import Library, NotionStub, WeReadStub
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENTRY_POINTS = ["book", "weread", "read_time"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=50)
+    parser.add_argument("--highlights", type=int, default=2000)
+    parser.add_argument("--reviews", type=int, default=None)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--notion-429", type=float, default=0.0, help="ratio of 429s")
+    parser.add_argument("--weread-429", type=float, default=0.0, help="ratio of 429s")
+    parser.add_argument("--retry-after", type=float, default=0.5)
+    parser.add_argument(
+        "--notion-rate", default="1000", help="NOTION_RATE_LIMIT for the clients"
+    )
+    parser.add_argument("--entry-points", nargs="+", default=ENTRY_POINTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    return parser.parse_args()
+
+
+def get_env(args, weread, notion):
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if k not in ["CC_URL", "CC_ID", "CC_PASSWORD", "HTTP_PROXY", "HTTPS_PROXY"]
+    }
+    env.update(
+        {
+            "PYTHONPATH": os.pathsep.join([ROOT, env.get("PYTHONPATH", "")]),
+            "NO_PROXY": "127.0.0.1,localhost",
+            "NOTION_TOKEN": "secret_benchmark",
+            "NOTION_PAGE": f"https://www.notion.so/{notion.root_id.replace('-', '')}",
+            "NOTION_BASE_URL": notion.url,
+            "NOTION_RATE_LIMIT": args.notion_rate,
+            "WEREAD_COOKIE": "wr_vid=1; wr_skey=benchmark",
+            "WEREAD_URL": f"{weread.url}/",
+            "WEREAD_API_URL": weread.url,
+        }
+    )
+    return env
+
+
+def diff(before, after):
+    result = {}
+    for endpoint, counter in after.items():
+        previous = before.get(endpoint, {})
+        delta = {k: v - previous.get(k, 0) for k, v in counter.items()}
+        if delta["count"]:
+            result[endpoint] = delta
+    return result
+
+
+def run(entry_point, cwd, env, servers):
+    before = [server.snapshot() for server in servers]
+    log_path = os.path.join(cwd, f"{entry_point}.log")
+    start = time.perf_counter()
+    with open(log_path, "a") as log:
+        code = subprocess.call(
+            [sys.executable, "-m", f"weread2notionpro.{entry_point}"],
+            cwd=cwd,
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+    wall_time = time.perf_counter() - start
+    if code != 0:
+        with open(log_path) as f:
+            print("".join(f.readlines()[-20:]))
+    endpoints = {}
+    for name, server, previous in zip(["weread", "notion"], servers, before):
+        for endpoint, counter in diff(previous, server.snapshot()).items():
+            endpoints[f"{name} {endpoint}"] = counter
+    return {
+        "entry_point": entry_point,
+        "exit_code": code,
+        "wall_time": round(wall_time, 3),
+        "requests": sum(x["count"] for x in endpoints.values()),
+        "endpoints": endpoints,
+    }
+
+
+def print_result(run_index, result):
+    print(
+        f"\nRun {run_index} {result['entry_point']}: {result['wall_time']:.2f}s, "
+        f"{result['requests']} requests, exit code {result['exit_code']}"
+    )
+    print(f"  {'endpoint':<48}{'count':>9}{'429':>7}{'bytes':>14}")
+    for endpoint, counter in sorted(result["endpoints"].items()):
+        print(
+            f"  {endpoint:<48}{counter['count']:>9}"
+            f"{counter['rate_limited']:>7}{counter['bytes']:>14}"
+        )
+
+
+def main():
+    args = parse_args()
+    library = Library(args.books, args.highlights, args.reviews, args.days, args.seed)
+    weread = WeReadStub(
+        library,
+        latency=args.latency,
+        rate_limit_ratio=args.weread_429,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    ).start()
+    notion = NotionStub(
+        latency=args.latency,
+        rate_limit_ratio=args.notion_429,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    ).start()
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as cwd:
+            env = get_env(args, weread, notion)
+            for run_index in range(1, args.runs + 1):
+                for entry_point in args.entry_points:
+                    result = run(entry_point, cwd, env, [weread, notion])
+                    result["run"] = run_index
+                    results.append(result)
+                    print_result(run_index, result)
+    finally:
+        weread.stop()
+        notion.stop()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,796 @@
+"""Local stand-ins for the WeRead and Notion APIs, for offline benchmarks"""
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+import uuid
+
+ID_PATTERN = re.compile(
+    r"[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}"
+)
+PAGE_SIZE = 100
+
+
+class StubServer:
+    """Threaded HTTP server with artificial latency, injected 429s and per-endpoint counters"""
+
+    def __init__(self, latency=0.0, rate_limit_ratio=0.0, retry_after=0.5, seed=0):
+        self.latency = latency
+        self.rate_limit_ratio = rate_limit_ratio
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = defaultdict(lambda: {"count": 0, "rate_limited": 0, "bytes": 0})
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes; avoid delayed-ACK stalls
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                stub.dispatch(self)
+
+            do_POST = do_PATCH = do_DELETE = do_GET
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self):
+        with self.lock:
+            return {key: dict(value) for key, value in self.counters.items()}
+
+    def dispatch(self, handler):
+        url = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        endpoint = f"{handler.command} {ID_PATTERN.sub('{id}', url.path)}"
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            limited = self.random.random() < self.rate_limit_ratio
+            counter = self.counters[endpoint]
+            counter["count"] += 1
+            counter["bytes"] += len(body)
+            if limited:
+                counter["rate_limited"] += 1
+        if limited:
+            status, data = 429, {
+                "object": "error",
+                "status": 429,
+                "code": "rate_limited",
+                "message": "Rate limited by the benchmark stub.",
+            }
+            headers = {"Retry-After": str(self.retry_after)}
+        else:
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            query_lists = parse_qs(url.query)
+            try:
+                payload = json.loads(body) if body else {}
+                status, data = self.handle(
+                    handler.command, url.path, query, payload, query_lists
+                )
+            except Exception as e:
+                status, data = 500, {"object": "error", "status": 500, "message": repr(e)}
+            headers = {}
+        raw = data if isinstance(data, bytes) else json.dumps(data).encode()
+        with self.lock:
+            self.counters[endpoint]["bytes"] += len(raw)
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(raw)))
+        for key, value in headers.items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(raw)
+
+    def handle(self, method, path, query, payload, query_lists):
+        raise NotImplementedError
+
+
+class Library:
+    """Synthetic WeRead account: books with highlights, notes, chapters and daily reading time"""
+
+    def __init__(self, books=50, highlights=2000, reviews=None, days=365, seed=0):
+        rng = random.Random(seed)
+        self.version = 1
+        self.books = []
+        self.bookmarks = defaultdict(list)
+        self.reviews = defaultdict(list)
+        self.chapters = {}
+        self.read_times = {}
+        # Midnight in Asia/Shanghai, as WeRead reports reading days
+        today = int(time.time()) // 86400 * 86400 - 8 * 3600
+        for day in range(days):
+            self.read_times[str(today - day * 86400)] = rng.randint(60, 7200)
+        days = list(self.read_times)
+        authors = [f"Author{i}" for i in range(max(books // 3, 1))]
+        categories = [f"Category{i}" for i in range(12)]
+        for i in range(books):
+            book_id = str(100000 + i)
+            chapters = rng.randint(5, 20)
+            self.chapters[book_id] = [
+                {
+                    "chapterUid": uid,
+                    "chapterIdx": uid,
+                    "updateTime": 1683825006,
+                    "readAhead": 0,
+                    "title": f"Chapter {uid}",
+                    "level": 1 if uid % 5 == 1 else 2,
+                }
+                for uid in range(1, chapters + 1)
+            ]
+            read_days = sorted(rng.sample(days, min(5, len(days))))
+            self.books.append(
+                {
+                    "bookId": book_id,
+                    "title": f"Book {i}",
+                    "author": " ".join(rng.sample(authors, min(2, len(authors)))),
+                    "cover": f"https://cdn.weread.qq.com/weread/cover/{i}/s_{book_id}.jpg",
+                    "intro": f"Introduction of book {i}",
+                    "isbn": f"978{book_id}",
+                    "categories": [{"title": rng.choice(categories)}],
+                    "newRating": rng.randint(600, 1000),
+                    "newRatingDetail": {"myRating": rng.choice(["good", "fair", ""])},
+                    "readingTime": rng.randint(0, 36000),
+                    "progress": rng.randint(0, 100),
+                    "markedStatus": rng.choice([2, 4]),
+                    "sort": 1700000000 + i,
+                    "readDays": {int(x): rng.randint(60, 3600) for x in read_days},
+                    "chapterCount": chapters,
+                }
+            )
+        reviews = highlights // 10 if reviews is None else reviews
+        for i in range(highlights):
+            book = self.books[rng.randrange(books)]
+            chapter = rng.randint(1, book["chapterCount"])
+            start = rng.randint(0, 10000)
+            self.bookmarks[book["bookId"]].append(
+                {
+                    "bookmarkId": f"{book['bookId']}_{chapter}_{start}-{start + 30}",
+                    "bookId": book["bookId"],
+                    "markText": f"Highlight {i} " * rng.randint(1, 8),
+                    "range": f"{start}-{start + 30}",
+                    "chapterUid": chapter,
+                    "colorStyle": rng.randint(1, 5),
+                    "style": rng.randint(0, 2),
+                    "type": 1,
+                    "bookVersion": 1,
+                    "createTime": int(rng.choice(days)) + 3600,
+                }
+            )
+        for i in range(reviews):
+            book = self.books[rng.randrange(books)]
+            start = rng.randint(0, 10000)
+            review = {
+                "reviewId": f"review_{i}",
+                "bookId": book["bookId"],
+                "content": f"Note {i} " * rng.randint(1, 8),
+                "abstract": f"Quoted text {i}",
+                "range": f"{start}-{start + 30}",
+                "chapterUid": rng.randint(1, book["chapterCount"]),
+                "type": 1,
+                "bookVersion": 1,
+                "createTime": int(rng.choice(days)) + 7200,
+            }
+            if i % 20 == 0:
+                # A book review, filed by WeReadApi under the Comments chapter
+                review = {**review, "type": 4, "star": 80}
+                review.pop("range")
+                review.pop("chapterUid")
+                review.pop("abstract")
+            self.reviews[book["bookId"]].append(review)
+
+
+class WeReadStub(StubServer):
+    """The WeRead endpoints used by WeReadApi, serving a Library"""
+
+    def __init__(self, library, **kwargs):
+        super().__init__(**kwargs)
+        self.library = library
+
+    def handle(self, method, path, query, payload, query_lists):
+        library = self.library
+        version = library.version
+        if path == "/":
+            return 200, b"<html></html>"
+        if path == "/shelf/sync":
+            if query.get("synckey") == str(version):
+                return 200, {"synckey": version, "books": [], "bookProgress": []}
+            return 200, {
+                "synckey": version,
+                "books": [
+                    {k: book[k] for k in ["bookId", "title", "author", "cover"]}
+                    for book in library.books
+                ],
+                "bookProgress": [
+                    {
+                        "bookId": book["bookId"],
+                        "readingTime": book["readingTime"],
+                        "progress": book["progress"],
+                    }
+                    for book in library.books
+                ],
+                "archive": [
+                    {"name": "Archive", "bookIds": [b["bookId"] for b in library.books[::7]]}
+                ],
+            }
+        if path == "/user/notebooks":
+            return 200, {
+                "books": [
+                    {
+                        "bookId": book["bookId"],
+                        "book": {"title": book["title"]},
+                        "sort": book["sort"],
+                        "noteCount": len(library.bookmarks[book["bookId"]]),
+                        "reviewCount": len(library.reviews[book["bookId"]]),
+                    }
+                    for book in library.books
+                    if library.bookmarks[book["bookId"]] or library.reviews[book["bookId"]]
+                ]
+            }
+        book = self.get_book(query.get("bookId"))
+        if path == "/book/info":
+            if book is None:
+                return 404, {"errcode": -2003, "errmsg": "book not found"}
+            keys = ["bookId", "title", "author", "cover", "intro", "isbn"]
+            keys += ["categories", "newRating", "newRatingDetail"]
+            return 200, {k: book[k] for k in keys}
+        if path == "/book/readinfo":
+            if book is None:
+                return 404, {"errcode": -2003, "errmsg": "book not found"}
+            read_days = book["readDays"]
+            return 200, {
+                "bookId": book["bookId"],
+                "markedStatus": book["markedStatus"],
+                "readingProgress": book["progress"],
+                "readingTime": book["readingTime"],
+                "totalReadDay": len(read_days),
+                "finishedDate": max(read_days) if book["markedStatus"] == 4 else None,
+                "lastReadingDate": max(read_days),
+                "beginReadingDate": min(read_days),
+                "readDetail": {
+                    "data": [{"readDate": k, "readTime": v} for k, v in read_days.items()]
+                },
+            }
+        if path == "/book/bookmarklist":
+            return 200, {"updated": library.bookmarks[query.get("bookId")]}
+        if path == "/review/list":
+            reviews = library.reviews[query.get("bookId")]
+            if query.get("syncKey") == str(version):
+                reviews = []
+            return 200, {
+                "synckey": version,
+                "reviews": [{"review": x} for x in reviews],
+                "removed": [],
+            }
+        if path == "/book/chapterInfos":
+            book_id = payload.get("bookIds")[0]
+            synckey = payload.get("synckeys")[0]
+            chapters = [] if synckey == version else library.chapters.get(book_id, [])
+            return 200, {
+                "data": [{"bookId": book_id, "synckey": version, "updated": chapters}]
+            }
+        if path == "/readdata/summary":
+            read_times = library.read_times
+            if query.get("synckey") == str(version):
+                read_times = {}
+            return 200, {"synckey": version, "readTimes": read_times}
+        return 404, {"errcode": -1, "errmsg": f"unknown endpoint {path}"}
+
+    def get_book(self, book_id):
+        if not hasattr(self, "books_by_id"):
+            self.books_by_id = {x["bookId"]: x for x in self.library.books}
+        return self.books_by_id.get(book_id)
+
+
+def key(id):
+    return id.replace("-", "")
+
+
+def dashed(key):
+    return str(uuid.UUID(key))
+
+
+def new_id():
+    return uuid.uuid4().hex
+
+
+def text_value(content):
+    return "".join(x.get("plain_text", "") for x in content or [])
+
+
+def rich_text(content):
+    """Turn rich text from a request into the form Notion returns"""
+    result = []
+    for x in content or []:
+        text = x.get("text", {}).get("content", x.get("plain_text", ""))
+        result.append(
+            {
+                "type": "text",
+                "text": {"content": text, "link": None},
+                "plain_text": text,
+                "annotations": {"color": "default"},
+                "href": None,
+            }
+        )
+    return result
+
+
+def property_value(type, value):
+    if type in ["title", "rich_text"]:
+        return rich_text(value)
+    if type == "relation":
+        return [{"id": dashed(key(x.get("id")))} for x in value or []]
+    return value
+
+
+def empty_value(type):
+    if type in ["title", "rich_text", "relation", "files", "multi_select"]:
+        return []
+    if type == "checkbox":
+        return False
+    return None
+
+
+class NotionError(Exception):
+    def __init__(self, status, code, message):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+class NotionStub(StubServer):
+    """In-memory Notion workspace behind the REST endpoints NotionHelper uses"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.state_lock = threading.Lock()
+        self.databases = {}
+        self.pages = {}
+        self.blocks = {}
+        self.children = defaultdict(list)
+        self.rows = defaultdict(dict)
+        # (database key, property, value) -> ordered set of page keys
+        self.index = defaultdict(dict)
+        self.root_id = self.create_root_page()
+
+    def handle(self, method, path, query, payload, query_lists):
+        parts = path.strip("/").split("/")[1:]
+        try:
+            with self.state_lock:
+                return 200, self.route(method, parts, query, payload, query_lists)
+        except NotionError as e:
+            return e.status, {
+                "object": "error",
+                "status": e.status,
+                "code": e.code,
+                "message": str(e),
+            }
+
+    def route(self, method, parts, query, payload, query_lists):
+        if parts[0] == "databases":
+            if len(parts) == 1 and method == "POST":
+                return self.create_database(payload)
+            database = self.get(self.databases, parts[1])
+            if len(parts) == 3 and parts[2] == "query":
+                return self.query(
+                    database, payload, query_lists.get("filter_properties")
+                )
+            if method == "PATCH":
+                for name, value in payload.get("properties", {}).items():
+                    type = next(x for x in value if x not in ["name", "id"])
+                    database["properties"][name] = self.schema_property(name, type, value)
+            return database
+        if parts[0] == "pages":
+            if len(parts) == 1 and method == "POST":
+                return self.create_page(payload)
+            page = self.get(self.pages, parts[1])
+            if method == "PATCH":
+                self.update_page(page, payload)
+            return page
+        if parts[0] == "blocks":
+            block = self.get_block(parts[1])
+            if len(parts) == 3 and method == "PATCH":
+                return self.append_children(block, payload)
+            if len(parts) == 3:
+                return self.list_children(block, query)
+            if method == "DELETE":
+                return self.delete_block(block)
+            if method == "PATCH":
+                for name, value in payload.items():
+                    if name in block:
+                        block[name] = value
+            return block
+        raise NotionError(400, "invalid_request_url", "Invalid request URL.")
+
+    def get(self, objects, id):
+        obj = objects.get(key(id))
+        if obj is None or obj.get("archived"):
+            raise NotionError(404, "object_not_found", f"Could not find {id}.")
+        return obj
+
+    def get_block(self, id):
+        if key(id) in self.pages:
+            return self.get(self.pages, id)
+        return self.get(self.blocks, id)
+
+    def create_root_page(self):
+        page_key = new_id()
+        self.pages[page_key] = {
+            "object": "page",
+            "id": dashed(page_key),
+            "parent": {"type": "workspace", "workspace": True},
+            "properties": {},
+            "archived": False,
+            "in_trash": False,
+        }
+        calendar = {"Title": "title", "Date": "date"}
+        dated = {"Date": "date", "Year": "relation", "Month": "relation"}
+        dated.update({"Week": "relation", "Day": "relation"})
+        schemas = {
+            "Bookshelf": {
+                "Title": "title", "BookId": "rich_text", "ISBN": "rich_text",
+                "Link": "url", "Author": "relation", "Sort": "number",
+                "Rating": "number", "Cover": "files", "Categories": "relation",
+                "Reading Status": "status", "Reading Time": "number",
+                "Reading Progress": "number", "Reading Days": "number",
+                "Start Reading Date": "date", "Last Reading Date": "date",
+                "Introduction": "rich_text", "Bookshelf Category": "select",
+                "My Rating": "select", "Douban Link": "url",
+                "Douban Comment": "rich_text", **dated,
+            },
+            "Notes": {
+                "Name": "title", "bookId": "rich_text", "reviewId": "rich_text",
+                "blockId": "rich_text", "chapterUid": "number",
+                "bookVersion": "number", "type": "number", "range": "rich_text",
+                "star": "number", "abstract": "rich_text", "Books": "relation",
+                **dated,
+            },
+            "Highlights": {
+                "Name": "title", "bookId": "rich_text", "range": "rich_text",
+                "bookmarkId": "rich_text", "blockId": "rich_text",
+                "chapterUid": "number", "bookVersion": "number",
+                "colorStyle": "number", "type": "number", "style": "number",
+                "Books": "relation", **dated,
+            },
+            "Day": {
+                "Title": "title", "Date": "date", "Timestamp": "number",
+                "Duration": "number", "Year": "relation", "Month": "relation",
+                "Week": "relation",
+            },
+            "Week": calendar,
+            "Month": calendar,
+            "Year": calendar,
+            "Categories": {"Title": "title"},
+            "Author": {"Title": "title"},
+            "Chapters": {
+                "Name": "title", "blockId": "rich_text", "chapterUid": "number",
+                "chapterIdx": "number", "readAhead": "number",
+                "updateTime": "number", "level": "number", "Books": "relation",
+            },
+        }
+        for title, schema in schemas.items():
+            self.create_database(
+                {
+                    "parent": {"type": "page_id", "page_id": dashed(page_key)},
+                    "title": [{"type": "text", "text": {"content": title}}],
+                    "properties": {name: {type: {}} for name, type in schema.items()},
+                }
+            )
+        embed = self.new_block(
+            {"type": "embed", "embed": {"url": "https://heatmap.malinkang.com/"}},
+            {"type": "page_id", "page_id": dashed(page_key)},
+        )
+        self.children[page_key].append(key(embed["id"]))
+        return dashed(page_key)
+
+    def schema_property(self, name, type, value):
+        return {"id": new_id()[:4], "name": name, "type": type, type: value.get(type) or {}}
+
+    def create_database(self, payload):
+        database_key = new_id()
+        parent = payload.get("parent")
+        title = rich_text(payload.get("title"))
+        properties = {}
+        for name, value in payload.get("properties", {}).items():
+            type = next(iter(value))
+            properties[name] = self.schema_property(name, type, value)
+        database = {
+            "object": "database",
+            "id": dashed(database_key),
+            "parent": parent,
+            "title": title,
+            "properties": properties,
+            "archived": False,
+            "in_trash": False,
+        }
+        self.databases[database_key] = database
+        block = {
+            "object": "block",
+            "id": dashed(database_key),
+            "parent": parent,
+            "type": "child_database",
+            "child_database": {"title": text_value(title)},
+            "has_children": False,
+            "archived": False,
+            "in_trash": False,
+        }
+        self.blocks[database_key] = block
+        self.children[key(parent.get("page_id"))].append(database_key)
+        return database
+
+    def create_page(self, payload):
+        parent = payload.get("parent")
+        database_key = key(parent.get("database_id") or "")
+        database = self.get(self.databases, database_key) if database_key else None
+        page_key = new_id()
+        page = {
+            "object": "page",
+            "id": dashed(page_key),
+            "parent": {"type": "database_id", "database_id": database["id"]}
+            if database
+            else parent,
+            "icon": payload.get("icon"),
+            "cover": payload.get("cover"),
+            "properties": {},
+            "archived": False,
+            "in_trash": False,
+        }
+        if database:
+            for name, schema in database["properties"].items():
+                page["properties"][name] = {
+                    "id": schema["id"],
+                    "type": schema["type"],
+                    schema["type"]: empty_value(schema["type"]),
+                }
+        self.pages[page_key] = page
+        if database:
+            self.rows[database_key][page_key] = None
+        self.update_page(page, payload)
+        for block in payload.get("children") or []:
+            self.add_block(page_key, block)
+        return page
+
+    def update_page(self, page, payload):
+        database_key = key(page["parent"].get("database_id") or "")
+        for name in ["icon", "cover", "archived", "in_trash"]:
+            if name in payload:
+                page[name] = payload[name]
+        for name, value in (payload.get("properties") or {}).items():
+            current = page["properties"].get(name)
+            if current is None:
+                raise NotionError(
+                    400, "validation_error", f"{name} is not a property that exists."
+                )
+            type = current["type"]
+            self.unindex(database_key, page, name)
+            current[type] = property_value(type, value.get(type))
+            self.reindex(database_key, page, name)
+        if page.get("archived"):
+            self.archive_page(page)
+
+    def index_keys(self, database_key, page, name):
+        current = page["properties"][name]
+        type = current["type"]
+        if type in ["title", "rich_text"]:
+            return [(database_key, name, text_value(current[type]))]
+        if type == "relation":
+            return [(database_key, name, key(x["id"])) for x in current[type]]
+        return []
+
+    def unindex(self, database_key, page, name):
+        for index_key in self.index_keys(database_key, page, name):
+            self.index[index_key].pop(key(page["id"]), None)
+
+    def reindex(self, database_key, page, name):
+        for index_key in self.index_keys(database_key, page, name):
+            self.index[index_key][key(page["id"])] = None
+
+    def archive_page(self, page):
+        page["archived"] = page["in_trash"] = True
+        database_key = key(page["parent"].get("database_id") or "")
+        if database_key:
+            self.rows[database_key].pop(key(page["id"]), None)
+            for name in page["properties"]:
+                self.unindex(database_key, page, name)
+
+    def query(self, database, payload, filter_properties):
+        database_key = key(database["id"])
+        filter = payload.get("filter")
+        candidates = self.candidates(database_key, filter)
+        if candidates is None:
+            candidates = self.rows[database_key]
+        rows = [self.pages[x] for x in candidates if self.matches(self.pages[x], filter)]
+        for sort in reversed(payload.get("sorts") or []):
+            name = sort.get("property")
+            present = [x for x in rows if self.sort_value(x, name) is not None]
+            present.sort(
+                key=lambda x: self.sort_value(x, name),
+                reverse=sort.get("direction") == "descending",
+            )
+            rows = present + [x for x in rows if self.sort_value(x, name) is None]
+        start = int(payload.get("start_cursor") or 0)
+        page_size = min(int(payload.get("page_size") or PAGE_SIZE), PAGE_SIZE)
+        results = rows[start : start + page_size]
+        if filter_properties:
+            ids = set(filter_properties)
+            results = [
+                {
+                    **x,
+                    "properties": {
+                        name: value
+                        for name, value in x["properties"].items()
+                        if value["id"] in ids
+                    },
+                }
+                for x in results
+            ]
+        has_more = start + page_size < len(rows)
+        return {
+            "object": "list",
+            "results": results,
+            "has_more": has_more,
+            "next_cursor": str(start + page_size) if has_more else None,
+        }
+
+    def candidates(self, database_key, filter):
+        """Narrow a query to an index entry when the filter allows it"""
+        if not filter:
+            return None
+        if "and" in filter:
+            for x in filter["and"]:
+                candidates = self.candidates(database_key, x)
+                if candidates is not None:
+                    return candidates
+            return None
+        for type in ["title", "rich_text"]:
+            if "equals" in (filter.get(type) or {}):
+                return list(self.index[(database_key, filter["property"], filter[type]["equals"])])
+        if "contains" in (filter.get("relation") or {}):
+            value = key(filter["relation"]["contains"])
+            return list(self.index[(database_key, filter["property"], value)])
+        return None
+
+    def matches(self, page, filter):
+        if not filter:
+            return True
+        if "and" in filter:
+            return all(self.matches(page, x) for x in filter["and"])
+        if "or" in filter:
+            return any(self.matches(page, x) for x in filter["or"])
+        property = page["properties"].get(filter.get("property"))
+        if property is None:
+            raise NotionError(
+                400, "validation_error", f"Could not find property {filter.get('property')}."
+            )
+        type = property["type"]
+        condition = filter.get(type)
+        if condition is None:
+            raise NotionError(400, "validation_error", f"Filter type must be {type}.")
+        value = property[type]
+        if type in ["title", "rich_text"]:
+            value = text_value(value)
+        elif type == "relation":
+            value = [key(x["id"]) for x in value]
+        if "is_empty" in condition:
+            return value in [None, "", []]
+        if "is_not_empty" in condition:
+            return value not in [None, "", []]
+        if "equals" in condition:
+            return value == condition["equals"]
+        if "contains" in condition:
+            target = condition["contains"]
+            return key(target) in value if type == "relation" else target in value
+        raise NotionError(400, "validation_error", f"Unsupported filter {condition}.")
+
+    def sort_value(self, page, name):
+        property = page["properties"].get(name)
+        value = property[property["type"]]
+        if property["type"] in ["title", "rich_text"]:
+            return text_value(value)
+        return value
+
+    def new_block(self, block, parent):
+        block_key = new_id()
+        type = block.get("type") or next(iter(block))
+        content = {k: v for k, v in block.get(type, {}).items() if k != "children"}
+        if "rich_text" in content:
+            content["rich_text"] = rich_text(content["rich_text"])
+        stored = {
+            "object": "block",
+            "id": dashed(block_key),
+            "parent": parent,
+            "type": type,
+            type: content,
+            "has_children": False,
+            "archived": False,
+            "in_trash": False,
+        }
+        self.blocks[block_key] = stored
+        for child in block.get(type, {}).get("children") or []:
+            self.add_block(block_key, child)
+        return stored
+
+    def add_block(self, parent_key, block, position=None):
+        parent_type = "page_id" if parent_key in self.pages else "block_id"
+        stored = self.new_block(block, {"type": parent_type, parent_type: dashed(parent_key)})
+        children = self.children[parent_key]
+        if position is None:
+            children.append(key(stored["id"]))
+        else:
+            children.insert(position, key(stored["id"]))
+        if parent_key in self.blocks:
+            self.blocks[parent_key]["has_children"] = True
+        return stored
+
+    def append_children(self, parent, payload):
+        parent_key = key(parent["id"])
+        children = self.children[parent_key]
+        position = None
+        if payload.get("after"):
+            after = key(payload["after"])
+            if after not in children:
+                raise NotionError(
+                    400, "validation_error", f"Block {payload['after']} is not a child of {parent['id']}."
+                )
+            position = children.index(after) + 1
+        results = []
+        for index, block in enumerate(payload.get("children") or []):
+            results.append(
+                self.add_block(
+                    parent_key, block, None if position is None else position + index
+                )
+            )
+        return {"object": "list", "results": results}
+
+    def list_children(self, parent, query):
+        children = [
+            self.blocks[x]
+            for x in self.children[key(parent["id"])]
+            if not self.blocks[x].get("archived")
+        ]
+        start = int(query.get("start_cursor") or 0)
+        page_size = min(int(query.get("page_size") or PAGE_SIZE), PAGE_SIZE)
+        has_more = start + page_size < len(children)
+        return {
+            "object": "list",
+            "results": children[start : start + page_size],
+            "has_more": has_more,
+            "next_cursor": str(start + page_size) if has_more else None,
+        }
+
+    def delete_block(self, block):
+        block_key = key(block["id"])
+        if block_key in self.pages:
+            self.archive_page(block)
+            return block
+        block["archived"] = block["in_trash"] = True
+        parent = block["parent"]
+        parent_key = key(parent.get(parent["type"]))
+        if block_key in self.children[parent_key]:
+            self.children[parent_key].remove(block_key)
+        return block
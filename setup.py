@@ -16,6 +16,7 @@ setup(
             "book = weread2notionpro.book:main",
             "weread = weread2notionpro.weread:main",
             "read_time = weread2notionpro.read_time:main",
+            "rebuild_state = weread2notionpro.state_store:main",
         ],
     },
     author="malinkang",
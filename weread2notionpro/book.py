@@ -1,5 +1,14 @@
+import atexit
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import os
+
 import pendulum
+from weread2notionpro.metrics import metrics
 from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.profiler import profile
+from weread2notionpro.state_store import open_state_store
 from weread2notionpro.weread_api import WeReadApi
 from weread2notionpro import utils
 from weread2notionpro.config import book_properties_type_dict, tz
@@ -8,18 +17,60 @@ TAG_ICON_URL = "https://www.notion.so/icons/tag_gray.svg"
 USER_ICON_URL = "https://www.notion.so/icons/user-circle-filled_gray.svg"
 BOOK_ICON_URL = "https://www.notion.so/icons/book_gray.svg"
 rating = {"poor": "⭐️", "fair": "⭐️⭐️⭐️", "good": "⭐️⭐️⭐️⭐️⭐️"}
+# Number of books whose WeRead metadata is fetched concurrently; 1 keeps the serial path
+PREFETCH_WORKERS = int(os.getenv("WEREAD_PREFETCH_WORKERS", "8"))
+# Scan Reading Records once instead of once per book when syncing at least this many books
+READ_RECORDS_BULK_THRESHOLD = int(os.getenv("READ_RECORDS_BULK_THRESHOLD", "20"))
+# Upload WeRead covers to the asset host and use those copies, see utils.mirror_cover
+MIRROR_COVERS = os.getenv("MIRROR_COVERS", "") == "1"
+COVER_DIR = os.getenv("COVER_DIR", "cover")
+# Reading Records properties written by insert_to_notion, the only ones read back from Notion
+READ_FIELDS = ["Title", "Date", "Duration", "Timestamp", "Bookshelf"]
+
+def fetch_book_data(book_id):
+    """Fetch book info and read info from WeRead"""
+    book_info = weread_api.get_bookinfo(book_id)
+    read_info = weread_api.get_read_info(book_id)
+    if uploads is not None and book_info and book_info.get("cover"):
+        book_info["mirroredCover"] = utils.mirror_cover(
+            get_cover_url(book_info.get("cover")), uploads, save_dir=COVER_DIR
+        )
+    return book_info, read_info
+
+def get_cover_url(cover):
+    """Large version of a WeRead cover"""
+    return cover.replace("/s_", "/t7_")
+
+def prefetch_book_data(book_ids, workers=PREFETCH_WORKERS):
+    """Yield (book_id, (book_info, read_info)) in input order, fetching ahead with a bounded pool"""
+    if workers <= 1:
+        for book_id in book_ids:
+            yield book_id, fetch_book_data(book_id)
+        return
+    book_ids = iter(book_ids)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque(
+            (book_id, executor.submit(fetch_book_data, book_id))
+            for book_id in islice(book_ids, workers * 2)
+        )
+        while pending:
+            book_id, future = pending.popleft()
+            for next_id in islice(book_ids, 1):
+                pending.append((next_id, executor.submit(fetch_book_data, next_id)))
+            yield book_id, future.result()
 
-def insert_book_to_notion(books, index, book_id):
+def insert_book_to_notion(books, index, book_id, book_data=None):
     """Insert Book to Notion"""
+    if book_data is None:
+        book_data = fetch_book_data(book_id)
+    book_info, read_info = book_data
     book = {}
     if book_id in archive_dict:
         book["Bookshelf Category"] = archive_dict.get(book_id)
     if book_id in notion_books:
         book.update(notion_books.get(book_id))
-    book_info = weread_api.get_bookinfo(book_id)
     if book_info != None:
         book.update(book_info)
-    read_info = weread_api.get_read_info(book_id)
     # Researched that this status is unknown in some cases, even when read, the status is still 1 markedStatus = 1 To-do 4 Complete Others are In Progress
     read_info.update(read_info.get("readDetail", {}))
     read_info.update(read_info.get("bookInfo", {}))
@@ -48,7 +99,9 @@ def insert_book_to_notion(books, index, book_id):
     )
     book["Start Reading Date"] = book.get("beginReadingDate")
     book["Last Reading Date"] = book.get("lastReadingDate")
-    cover = book.get("cover").replace("/s_", "/t7_")
+    cover = get_cover_url(book.get("cover"))
+    if (book.get("mirroredCover") or "").startswith("http"):
+        cover = book.get("mirroredCover")
     if not cover or not cover.strip() or not cover.startswith("http"):
         cover = BOOK_ICON_URL
     if book_id not in notion_books:
@@ -87,6 +140,8 @@ def insert_book_to_notion(books, index, book_id):
             page_id=notion_books.get(book_id).get("pageId"),
             properties=properties,
             cover=utils.get_icon(cover),
+            current=notion_books.get(book_id).get("values"),
+            current_cover=notion_books.get(book_id).get("cover"),
         )
     else:
         result = notion_helper.create_book_page(
@@ -100,27 +155,45 @@ def insert_book_to_notion(books, index, book_id):
         data = {item.get("readDate"): item.get("readTime") for item in data}
         insert_read_data(page_id, data)
 
+def load_read_records():
+    """Index every Reading Records row by book page id and timestamp"""
+    records = {}
+    for row in notion_helper.iter_rows(
+        notion_helper.read_database_id, READ_FIELDS, values=True
+    ):
+        for x in row.get("Bookshelf", []):
+            book_records = records.setdefault(x.get("id").replace("-", ""), {})
+            book_records.setdefault(row.get("Timestamp"), row)
+    return records
+
 def insert_read_data(page_id, read_times):
     read_times = dict(sorted(read_times.items()))
-    filter = {"property": "Bookshelf", "relation": {"contains": page_id}}
-    results = notion_helper.query_all_by_book(notion_helper.read_database_id, filter)
-    for result in results:
-        timestamp = result.get("properties").get("Timestamp").get("number")
-        duration = result.get("properties").get("Duration").get("number")
-        id = result.get("id")
+    if read_records is not None:
+        rows = read_records.get(page_id.replace("-", ""), {}).values()
+    else:
+        filter = {"property": "Bookshelf", "relation": {"contains": page_id}}
+        # Read every page before writing, so updates cannot shift the pagination
+        rows = list(
+            notion_helper.iter_rows(
+                notion_helper.read_database_id, READ_FIELDS, filter, values=True
+            )
+        )
+    for row in rows:
+        timestamp = row.get("Timestamp")
         if timestamp in read_times:
             value = read_times.pop(timestamp)
-            if value != duration:
+            if value != row.get("Duration"):
                 insert_to_notion(
-                    page_id=id,
+                    page_id=row.id,
                     timestamp=timestamp,
                     duration=value,
                     book_database_id=page_id,
+                    current=row.values,
                 )
     for key, value in read_times.items():
         insert_to_notion(None, int(key), value, page_id)
 
-def insert_to_notion(page_id, timestamp, duration, book_database_id):
+def insert_to_notion(page_id, timestamp, duration, book_database_id, current=None):
     parent = {"database_id": notion_helper.read_database_id, "type": "database_id"}
     properties = {
         "Title": utils.get_title(
@@ -136,7 +209,7 @@ def insert_to_notion(page_id, timestamp, duration, book_database_id):
         "Bookshelf": utils.get_relation([book_database_id]),
     }
     if page_id != None:
-        notion_helper.client.pages.update(page_id=page_id, properties=properties)
+        notion_helper.update_page(page_id, properties, current=current)
     else:
         notion_helper.client.pages.create(
             parent=parent,
@@ -144,14 +217,26 @@ def insert_to_notion(page_id, timestamp, duration, book_database_id):
             properties=properties,
         )
 
-weread_api = WeReadApi()
+weread_api = WeReadApi(open_state_store())
 notion_helper = NotionHelper()
 archive_dict = {}
 notion_books = {}
+read_records = None
+# {sha256 of a cover: upload response}, only when MIRROR_COVERS is set
+uploads = None
 
+@profile("book")
 def main():
     global notion_books
     global archive_dict
+    global read_records
+    global uploads
+    atexit.register(metrics.report, "book")
+    if MIRROR_COVERS:
+        uploads = utils.load_uploads(COVER_DIR)
+        atexit.register(utils.save_uploads, COVER_DIR, uploads)
+    weread_api.start()
+    notion_helper.start()
     bookshelf_books = weread_api.get_bookshelf()
     notion_books = notion_helper.get_all_book()
     book_progress = bookshelf_books.get("bookProgress")
@@ -180,8 +265,15 @@ def main():
     books = bookshelf_books.get("books")
     books = [d["bookId"] for d in books if "bookId" in d]
     books = list((set(notebooks) | set(books)) - set(not_need_sync))
-    for index, book_id in enumerate(books):
-        insert_book_to_notion(books, index, book_id)
+    # Only new books link to Author and Categories pages
+    if any(book_id not in notion_books for book_id in books):
+        notion_helper.load_relation_index(notion_helper.author_database_id)
+        notion_helper.load_relation_index(notion_helper.category_database_id)
+    if len(books) >= READ_RECORDS_BULK_THRESHOLD:
+        read_records = load_read_records()
+    for index, (book_id, book_data) in enumerate(prefetch_book_data(books)):
+        insert_book_to_notion(books, index, book_id, book_data)
+    print(f"Skipped {notion_helper.skipped_writes} unchanged Notion writes.")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,271 @@
+"""Record the WeRead and Notion traffic of a run to a compressed cassette, and replay it offline
+
+HTTP_CASSETTE=record runs normally and writes HTTP_CASSETTE_DIR/<entry point>.jsonl.gz at
+exit; HTTP_CASSETTE=replay serves every request from that file without touching the network
+(set NOTION_TOKEN and NOTION_PAGE to the values used when recording; CookieCloud is skipped).
+"""
+import atexit
+from collections import defaultdict, deque
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from weread2notionpro.metrics import endpoint_name
+
+HTTP_CASSETTE = os.getenv("HTTP_CASSETTE", "")
+HTTP_CASSETTE_DIR = os.getenv("HTTP_CASSETTE_DIR", "cassettes")
+# Mask highlights, notes and secrets so cassettes can be shared; ids and titles are kept
+HTTP_CASSETTE_SCRUB = os.getenv("HTTP_CASSETTE_SCRUB", "1") == "1"
+# Sleep for the recorded response time when replaying
+HTTP_CASSETTE_LATENCY = os.getenv("HTTP_CASSETTE_LATENCY", "") == "1"
+SCRUB_KEYS = {
+    "weread": {"markText", "content", "abstract", "intro"},
+    "notion": {"plain_text", "content"},
+}
+# Notion text is only masked inside these properties and block types
+SCRUB_SCOPES = {
+    "weread": None,
+    "notion": {
+        "Name", "abstract", "Introduction", "Douban Comment", "NotionToken",
+        "NotionPage", "WeReadCookie", "callout", "quote", "paragraph",
+        "bulleted_list_item", "numbered_list_item",
+    },
+}
+KEPT_HEADERS = ["content-type", "retry-after"]
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+class Cassette:
+    """Recorded request/response pairs, matched on replay by method, URL and query body"""
+
+    def __init__(self, path, mode, scrub=HTTP_CASSETTE_SCRUB):
+        if mode not in ["record", "replay"]:
+            raise Exception(f"Unknown HTTP_CASSETTE mode {mode}, use record or replay.")
+        self.path = path
+        self.mode = mode
+        self.scrub = scrub
+        self.lock = threading.Lock()
+        self.interactions = []
+        self.used = set()
+        self.by_key = defaultdict(deque)
+        self.by_endpoint = defaultdict(deque)
+        if mode == "replay":
+            self.load()
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            self.scrub = header.get("scrub")
+            for line in f:
+                self.add(json.loads(line))
+        print(f"Replaying {len(self.interactions)} requests from {self.path}")
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            interactions = list(self.interactions)
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps({"version": 1, "scrub": self.scrub}) + "\n")
+            for interaction in interactions:
+                f.write(json.dumps(interaction, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        print(f"Recorded {len(interactions)} requests to {self.path}")
+
+    def add(self, interaction):
+        with self.lock:
+            index = len(self.interactions)
+            self.interactions.append(interaction)
+            self.by_key[interaction["key"]].append(index)
+            self.by_endpoint[interaction["endpoint"]].append(index)
+
+    def match_key(self, service, method, url, body):
+        """Method, path and sorted query, plus a digest of the body of read requests"""
+        url = urlparse(url)
+        key = f"{service} {method} {url.path}?{urlencode(sorted(parse_qsl(url.query)))}"
+        if body and (service == "weread" or url.path.endswith("/query")):
+            if isinstance(body, str):
+                body = body.encode()
+            try:
+                body = json.dumps(
+                    self.scrub_value(service, json.loads(body)), sort_keys=True
+                ).encode()
+            except ValueError:
+                pass
+            key += f" {hashlib.sha1(body).hexdigest()}"
+        return key
+
+    def record(self, service, method, url, body, status, headers, content, elapsed):
+        self.add(
+            {
+                "key": self.match_key(service, method, url, body),
+                "endpoint": f"{service} {endpoint_name(method, urlparse(url).path)}",
+                "status": status,
+                "headers": {k: headers[k] for k in KEPT_HEADERS if k in headers},
+                "content": self.scrub_content(service, content),
+                "elapsed": round(elapsed, 4),
+            }
+        )
+
+    def play(self, service, method, url, body):
+        """Return (status, headers, content) of the next unused matching recording"""
+        key = self.match_key(service, method, url, body)
+        endpoint = f"{service} {endpoint_name(method, urlparse(url).path)}"
+        with self.lock:
+            # Fall back to any recording of the same endpoint, e.g. when scrubbing changed a body
+            for queue in [self.by_key[key], self.by_endpoint[endpoint]]:
+                while queue and queue[0] in self.used:
+                    queue.popleft()
+                if queue:
+                    index = queue.popleft()
+                    self.used.add(index)
+                    interaction = self.interactions[index]
+                    break
+            else:
+                raise CassetteMiss(f"No recorded response for {method} {url}")
+        if HTTP_CASSETTE_LATENCY:
+            time.sleep(interaction["elapsed"])
+        return (
+            interaction["status"],
+            interaction["headers"],
+            interaction["content"].encode("utf-8"),
+        )
+
+    def scrub_content(self, service, content):
+        try:
+            data = json.loads(content)
+        except ValueError:
+            return "" if self.scrub else content.decode("utf-8", "replace")
+        return json.dumps(self.scrub_value(service, data), ensure_ascii=False)
+
+    def scrub_value(self, service, value, key=None, in_scope=False):
+        """Replace free text with x's of the same length, leaving ids and numbers intact"""
+        if not self.scrub:
+            return value
+        scopes = SCRUB_SCOPES[service]
+        in_scope = in_scope or scopes is None or key in scopes
+        if isinstance(value, dict):
+            return {k: self.scrub_value(service, v, k, in_scope) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.scrub_value(service, x, key, in_scope) for x in value]
+        if in_scope and isinstance(value, str) and key in SCRUB_KEYS[service]:
+            return "x" * len(value)
+        return value
+
+
+class CassetteAdapter(HTTPAdapter):
+    """requests adapter that records to or replays from a cassette"""
+
+    def __init__(self, cassette, service, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+        self.service = service
+
+    def send(self, request, **kwargs):
+        if self.cassette.replaying:
+            status, headers, content = self.cassette.play(
+                self.service, request.method, request.url, request.body
+            )
+            response = requests.Response()
+            response.status_code = status
+            response.headers = CaseInsensitiveDict(headers)
+            response._content = content
+            response.encoding = "utf-8"
+            response.url = request.url
+            response.request = request
+            return response
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        self.cassette.record(
+            self.service,
+            request.method,
+            request.url,
+            request.body,
+            response.status_code,
+            response.headers,
+            response.content,
+            time.perf_counter() - start,
+        )
+        return response
+
+
+class CassetteTransport(httpx.BaseTransport):
+    """httpx transport that records to or replays from a cassette"""
+
+    def __init__(self, cassette, service, transport=None):
+        self.cassette = cassette
+        self.service = service
+        self.transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request):
+        if self.cassette.replaying:
+            status, headers, content = self.cassette.play(
+                self.service, request.method, str(request.url), request.content
+            )
+            return httpx.Response(status, headers=headers, content=content, request=request)
+        start = time.perf_counter()
+        response = self.transport.handle_request(request)
+        try:
+            content = response.read()
+        finally:
+            response.close()
+        self.cassette.record(
+            self.service,
+            request.method,
+            str(request.url),
+            request.content,
+            response.status_code,
+            {k.lower(): v for k, v in response.headers.items()},
+            content,
+            time.perf_counter() - start,
+        )
+        return httpx.Response(
+            response.status_code, headers=response.headers, content=content, request=request
+        )
+
+    def close(self):
+        self.transport.close()
+
+
+cassette = None
+cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """The cassette of this process, or None unless HTTP_CASSETTE is set"""
+    global cassette
+    if not HTTP_CASSETTE:
+        return None
+    with cassette_lock:
+        if cassette is None:
+            name = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "cassette"
+            path = os.path.join(HTTP_CASSETTE_DIR, f"{name}.jsonl.gz")
+            cassette = Cassette(path, HTTP_CASSETTE)
+            if not cassette.replaying:
+                atexit.register(cassette.save)
+        return cassette
+
+
+def notion_http_client():
+    """httpx client for the Notion SDK, going through the cassette when one is active"""
+    cassette = get_cassette()
+    if cassette is None:
+        return None
+    return httpx.Client(transport=CassetteTransport(cassette, "notion"))
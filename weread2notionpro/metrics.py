@@ -0,0 +1,141 @@
+import json
+import math
+import os
+import re
+import threading
+import time
+
+# Folder for the <entry point>_metrics.json summaries; empty keeps only the printed table
+METRICS_DIR = os.getenv("METRICS_DIR", ".")
+ID_PATTERN = re.compile(
+    r"[a-f0-9]{8}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{4}-?[a-f0-9]{12}"
+)
+# Latency histogram buckets grow by 10% from 0.1ms, so percentiles are within 10%
+BUCKET_BASE = 0.0001
+BUCKET_GROWTH = 1.1
+
+
+class EndpointStats:
+    __slots__ = ["count", "errors", "retries", "bytes", "max", "buckets"]
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds, bytes, error, retry):
+        self.count += 1
+        self.errors += int(error)
+        self.retries += int(retry)
+        self.bytes += bytes
+        self.max = max(self.max, seconds)
+        bucket = bucket_index(seconds)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q):
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(BUCKET_BASE * BUCKET_GROWTH**bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "retries": self.retries,
+            "p50_ms": round(self.percentile(0.5) * 1000, 1),
+            "p95_ms": round(self.percentile(0.95) * 1000, 1),
+            "max_ms": round(self.max * 1000, 1),
+            "bytes": self.bytes,
+        }
+
+
+class Metrics:
+    """Request counters and latency histograms of every WeRead and Notion endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        # Run-wide totals that belong to no single endpoint, e.g. notion_throttled_seconds
+        self.counters = {}
+        self.started = time.time()
+
+    def record(self, service, endpoint, seconds, bytes=0, error=False, retry=False):
+        key = (service, endpoint)
+        with self.lock:
+            if key not in self.endpoints:
+                self.endpoints[key] = EndpointStats()
+            self.endpoints[key].add(seconds, bytes, error, retry)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        with self.lock:
+            return {
+                f"{service} {endpoint}": stats.to_dict()
+                for (service, endpoint), stats in sorted(self.endpoints.items())
+            }
+
+    def table(self):
+        summary = self.summary()
+        lines = [
+            f"{'Endpoint':<44}{'Count':>8}{'Errors':>8}{'Retries':>8}"
+            f"{'p50 ms':>9}{'p95 ms':>9}{'Max ms':>9}{'KB':>10}"
+        ]
+        for endpoint, x in summary.items():
+            lines.append(
+                f"{endpoint:<44}{x['count']:>8}{x['errors']:>8}{x['retries']:>8}"
+                f"{x['p50_ms']:>9}{x['p95_ms']:>9}{x['max_ms']:>9}{x['bytes'] // 1024:>10}"
+            )
+        with self.lock:
+            counters = sorted(self.counters.items())
+        for name, value in counters:
+            value = round(value, 1) if isinstance(value, float) else value
+            lines.append(f"{name:<44}{value:>8}")
+        return "\n".join(lines)
+
+    def report(self, name):
+        """Print the table and write <name>_metrics.json into METRICS_DIR"""
+        if not self.endpoints:
+            return
+        print(self.table())
+        if not METRICS_DIR:
+            return
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{name}_metrics.json")
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "entry_point": name,
+                    "started": self.started,
+                    "wall_time": round(time.time() - self.started, 3),
+                    "endpoints": self.summary(),
+                    "counters": {
+                        name: round(value, 3) for name, value in self.counters.items()
+                    },
+                },
+                f,
+                indent=4,
+            )
+
+
+def bucket_index(seconds):
+    if seconds <= BUCKET_BASE:
+        return 0
+    return math.ceil(math.log(seconds / BUCKET_BASE, BUCKET_GROWTH))
+
+
+def endpoint_name(method, path):
+    """Name an endpoint by method and path, with Notion ids replaced by {id}"""
+    return f"{method} /{ID_PATTERN.sub('{id}', path.lstrip('/'))}"
+
+
+metrics = Metrics()
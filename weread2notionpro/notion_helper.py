@@ -1,15 +1,22 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import json
 import logging
 import os
 import re
-import time
+import threading
+from urllib.parse import unquote
 
-from notion_client import Client
 import pendulum
-from retrying import retry
 from datetime import timedelta
 from dotenv import load_dotenv
 
 load_dotenv()
+from notion_client.errors import APIErrorCode, APIResponseError
+from weread2notionpro.cassette import notion_http_client
+from weread2notionpro.config import book_properties_type_dict
+from weread2notionpro.relation_cache import RELATION_CACHE, RelationCache
+from weread2notionpro.scheduler import ScheduledClient
 from weread2notionpro.utils import (
     format_date,
     get_date,
@@ -23,12 +30,75 @@ from weread2notionpro.utils import (
     get_title,
     timestamp_to_date,
     get_property_value,
+    get_diff_value,
+    diff_properties,
 )
 
 TAG_ICON_URL = "https://www.notion.so/icons/tag_gray.svg"
 USER_ICON_URL = "https://www.notion.so/icons/user-circle-filled_gray.svg"
 TARGET_ICON_URL = "https://www.notion.so/icons/target_red.svg"
 BOOKMARK_ICON_URL = "https://www.notion.so/icons/bookmark_gray.svg"
+NOTION_BASE_URL = os.getenv("NOTION_BASE_URL", "https://api.notion.com")
+NOTION_MANIFEST = os.getenv("NOTION_MANIFEST", "notion_manifest.json")
+DISCOVERY_WORKERS = int(os.getenv("NOTION_DISCOVERY_WORKERS", "4"))
+# Bookshelf properties read back by get_all_book: everything book.py writes, plus Douban Comment
+BOOK_FIELDS = list(book_properties_type_dict) + [
+    "Douban Comment",
+    "Year",
+    "Month",
+    "Week",
+    "Day",
+]
+DATABASE_ATTRIBUTES = {
+    "book_database_id": "BOOK_DATABASE_NAME",
+    "review_database_id": "REVIEW_DATABASE_NAME",
+    "bookmark_database_id": "BOOKMARK_DATABASE_NAME",
+    "day_database_id": "DAY_DATABASE_NAME",
+    "week_database_id": "WEEK_DATABASE_NAME",
+    "month_database_id": "MONTH_DATABASE_NAME",
+    "year_database_id": "YEAR_DATABASE_NAME",
+    "category_database_id": "CATEGORY_DATABASE_NAME",
+    "author_database_id": "AUTHOR_DATABASE_NAME",
+    "chapter_database_id": "CHAPTER_DATABASE_NAME",
+    "read_database_id": "READ_DATABASE_NAME",
+    "setting_database_id": "SETTING_DATABASE_NAME",
+}
+
+
+def manifest_id(attribute):
+    """Id attribute that re-checks a value loaded from the manifest the first time it is read"""
+
+    def get(self):
+        value = self.__dict__.get(attribute)
+        if value is not None and value in self.unchecked_ids:
+            value = self.check_manifest_id(attribute, value)
+        return value
+
+    def set(self, value):
+        self.__dict__[attribute] = value
+
+    return property(get, set)
+
+
+class Row:
+    """A database page reduced to its id, cover and a few properties decoded with get_property_value"""
+
+    __slots__ = ["id", "cover", "fields", "data", "values"]
+
+    def __init__(self, id, cover, fields, data, values=None):
+        self.id = id
+        self.cover = cover
+        # {property name: index in data}, shared by every row of a query
+        self.fields = fields
+        self.data = data
+        # {property name: get_diff_value}, for update_page(current=...)
+        self.values = values
+
+    def get(self, name, default=None):
+        index = self.fields.get(name)
+        if index is None or self.data[index] is None:
+            return default
+        return self.data[index]
 
 
 class NotionHelper:
@@ -47,55 +117,62 @@ class NotionHelper:
         "SETTING_DATABASE_NAME": "Settings",
     }
     database_id_dict = {}
-    heatmap_block_id = None
+    heatmap_block_id = manifest_id("heatmap_block_id")
+    book_database_id = manifest_id("book_database_id")
+    review_database_id = manifest_id("review_database_id")
+    bookmark_database_id = manifest_id("bookmark_database_id")
+    day_database_id = manifest_id("day_database_id")
+    week_database_id = manifest_id("week_database_id")
+    month_database_id = manifest_id("month_database_id")
+    year_database_id = manifest_id("year_database_id")
+    category_database_id = manifest_id("category_database_id")
+    author_database_id = manifest_id("author_database_id")
+    chapter_database_id = manifest_id("chapter_database_id")
+    read_database_id = manifest_id("read_database_id")
+    setting_database_id = manifest_id("setting_database_id")
     show_color = True
     block_type = "callout"
     sync_bookmark = True
 
     def __init__(self):
-        self.client = Client(auth=os.getenv("NOTION_TOKEN"), log_level=logging.ERROR)
+        self.client = None
+        self.unchecked_ids = set()
+        self.page_searched = False
+        self.manifest_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.skipped_writes = 0
         self.__cache = {}
-        self.page_id = self.extract_page_id(os.getenv("NOTION_PAGE"))
-        self.search_database(self.page_id)
+        self.__indexed_databases = set()
+        self.__relation_locks = {}
+        self.__relation_lock = threading.Lock()
+        # database id -> {property name: property id}, for filter_properties
+        self.__property_ids = {}
+        self.__property_ids_lock = threading.Lock()
+        # block id -> parent object, filled from append/list responses and known state
+        self.block_parent_cache = {}
+        self.relation_cache = None
+        if RELATION_CACHE:
+            self.relation_cache = RelationCache(RELATION_CACHE)
+            atexit.register(self.relation_cache.save)
         for key in self.database_name_dict.keys():
             if os.getenv(key) != None and os.getenv(key) != "":
                 self.database_name_dict[key] = os.getenv(key)
-        self.book_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("BOOK_DATABASE_NAME")
-        )
-        self.review_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("REVIEW_DATABASE_NAME")
-        )
-        self.bookmark_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("BOOKMARK_DATABASE_NAME")
-        )
-        self.day_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("DAY_DATABASE_NAME")
-        )
-        self.week_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("WEEK_DATABASE_NAME")
-        )
-        self.month_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("MONTH_DATABASE_NAME")
-        )
-        self.year_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("YEAR_DATABASE_NAME")
-        )
-        self.category_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("CATEGORY_DATABASE_NAME")
-        )
-        self.author_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("AUTHOR_DATABASE_NAME")
-        )
-        self.chapter_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("CHAPTER_DATABASE_NAME")
-        )
-        self.read_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("READ_DATABASE_NAME")
-        )
-        self.setting_database_id = self.database_id_dict.get(
-            self.database_name_dict.get("SETTING_DATABASE_NAME")
+        self.started = False
+
+    def start(self):
+        """Find the databases under NOTION_PAGE and prepare them; does nothing once started"""
+        if self.started:
+            return self
+        self.client = ScheduledClient(
+            auth=os.getenv("NOTION_TOKEN"),
+            log_level=logging.ERROR,
+            base_url=NOTION_BASE_URL,
+            client=notion_http_client(),
         )
+        self.page_id = self.extract_page_id(os.getenv("NOTION_PAGE"))
+        if not self.load_manifest():
+            self.search_database(self.page_id)
+        self.assign_database_ids()
         self.update_book_database()
         if self.read_database_id is None:
             self.create_database()
@@ -103,6 +180,9 @@ class NotionHelper:
             self.create_setting_database()
         if self.setting_database_id:
             self.insert_to_setting_database()
+        self.save_manifest()
+        self.started = True
+        return self
 
     def extract_page_id(self, notion_url):
         # Regular expression to match 32-character Notion page_id
@@ -116,17 +196,119 @@ class NotionHelper:
             raise Exception("Failed to get Notion ID. Please check the provided URL.")
 
     def search_database(self, block_id):
-        children = self.client.blocks.children.list(block_id=block_id)["results"]
-        for child in children:
-            if child["type"] == "child_database":
-                self.database_id_dict[child.get("child_database").get("title")] = (
-                    child.get("id")
-                )
-            elif child["type"] == "embed" and child.get("embed").get("url"):
-                if child.get("embed").get("url").startswith("https://heatmap.malinkang.com/"):
-                    self.heatmap_block_id = child.get("id")
-            if "has_children" in child and child["has_children"]:
-                self.search_database(child["id"])
+        """Walk the page tree breadth-first, listing the blocks of each level concurrently"""
+        self.page_searched = True
+        level = [block_id]
+        with ThreadPoolExecutor(max_workers=DISCOVERY_WORKERS) as executor:
+            while level:
+                next_level = []
+                for children in executor.map(self.list_block_children, level):
+                    for child in children:
+                        if child["type"] == "child_database":
+                            self.database_id_dict[
+                                child.get("child_database").get("title")
+                            ] = child.get("id")
+                        elif child["type"] == "embed" and child.get("embed").get("url"):
+                            if child.get("embed").get("url").startswith("https://heatmap.malinkang.com/"):
+                                self.heatmap_block_id = child.get("id")
+                        if "has_children" in child and child["has_children"]:
+                            next_level.append(child["id"])
+                level = next_level
+
+    def list_block_children(self, block_id):
+        """List every child of a block, following pagination"""
+        results = []
+        start_cursor = None
+        while True:
+            response = self.client.blocks.children.list(
+                block_id=block_id, start_cursor=start_cursor, page_size=100
+            )
+            results.extend(response.get("results"))
+            if not response.get("has_more"):
+                return results
+            start_cursor = response.get("next_cursor")
+
+    def assign_database_ids(self):
+        for attribute, key in DATABASE_ATTRIBUTES.items():
+            setattr(
+                self,
+                attribute,
+                self.database_id_dict.get(self.database_name_dict.get(key)),
+            )
+
+    def load_manifest(self):
+        """Load the ids found by an earlier search of the same page, to be re-checked on use"""
+        if not NOTION_MANIFEST or not os.path.exists(NOTION_MANIFEST):
+            return False
+        try:
+            with open(NOTION_MANIFEST) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if not isinstance(manifest, dict) or manifest.get("page_id") != self.page_id:
+            return False
+        databases = manifest.get("databases")
+        heatmap_block_id = manifest.get("heatmap_block_id")
+        if (
+            not isinstance(databases, dict)
+            or not all(isinstance(x, str) for x in databases.values())
+            or not isinstance(heatmap_block_id, (str, type(None)))
+        ):
+            print("Notion manifest is malformed, searching the page again.")
+            return False
+        # A database added to the page since the last search is only found by searching;
+        # a missing heatmap embed is looked for only when it is needed, see get_heatmap_block_id
+        if any(name not in databases for name in self.database_name_dict.values()):
+            return False
+        self.database_id_dict.update(databases)
+        self.heatmap_block_id = heatmap_block_id
+        self.unchecked_ids = set(self.database_id_dict.values())
+        if self.heatmap_block_id:
+            self.unchecked_ids.add(self.heatmap_block_id)
+        return True
+
+    def save_manifest(self):
+        if not NOTION_MANIFEST:
+            return
+        manifest = {
+            "page_id": self.page_id,
+            "databases": self.database_id_dict,
+            "heatmap_block_id": self.__dict__.get("heatmap_block_id"),
+        }
+        with open(NOTION_MANIFEST, "w") as f:
+            json.dump(manifest, f, indent=4, ensure_ascii=False)
+
+    def check_manifest_id(self, attribute, value):
+        """Retrieve a manifest id once; search the page again if it is gone"""
+        with self.manifest_lock:
+            if value not in self.unchecked_ids:
+                return self.__dict__.get(attribute)
+            try:
+                block = self.client.blocks.retrieve(value)
+                found = not block.get("archived") and not block.get("in_trash")
+            except APIResponseError as e:
+                if e.code != APIErrorCode.ObjectNotFound:
+                    raise
+                found = False
+            if found:
+                self.unchecked_ids.discard(value)
+                return value
+            print("Notion manifest is out of date, searching the page again.")
+            self.unchecked_ids.clear()
+            self.database_id_dict.clear()
+            self.heatmap_block_id = None
+            self.search_database(self.page_id)
+            self.assign_database_ids()
+            self.save_manifest()
+            return self.__dict__.get(attribute)
+
+    def get_heatmap_block_id(self):
+        """The heatmap embed, searching the page again when the manifest has none"""
+        if self.heatmap_block_id is None and not self.page_searched:
+            self.search_database(self.page_id)
+            self.assign_database_ids()
+            self.save_manifest()
+        return self.heatmap_block_id
 
     def update_book_database(self):
         """Update database"""
@@ -160,7 +342,10 @@ class NotionHelper:
         ):
             update_properties["Douban Comment"] = {"rich_text": {}}
         if len(update_properties) > 0:
-            self.client.databases.update(database_id=id, properties=update_properties)
+            response = self.client.databases.update(
+                database_id=id, properties=update_properties
+            )
+        self.cache_property_ids(self.book_database_id, response)
 
     def create_database(self):
         title = [
@@ -190,6 +375,9 @@ class NotionHelper:
             icon=get_icon("https://www.notion.so/icons/target_gray.svg"),
             properties=properties,
         ).get("id")
+        self.database_id_dict[
+            self.database_name_dict.get("READ_DATABASE_NAME")
+        ] = self.read_database_id
 
     def create_setting_database(self):
         title = [
@@ -227,6 +415,9 @@ class NotionHelper:
             icon=get_icon("https://www.notion.so/icons/gear_gray.svg"),
             properties=properties,
         ).get("id")
+        self.database_id_dict[
+            self.database_name_dict.get("SETTING_DATABASE_NAME")
+        ] = self.setting_database_id
 
     def insert_to_setting_database(self):
         existing_pages = self.query(database_id=self.setting_database_id, filter={"property": "Title", "title": {"equals": "Settings"}}).get("results")
@@ -311,21 +502,66 @@ class NotionHelper:
             day, self.day_database_id, TARGET_ICON_URL, properties
         )
 
+    def load_relation_index(self, database_id):
+        """Load the Title -> page id of every page in a database with paginated bulk queries"""
+        for result in self.iter_query(database_id, properties=["Title"]):
+            title = get_property_value(result.get("properties").get("Title"))
+            if title is not None:
+                self.__cache.setdefault(f"{database_id}{title}", result.get("id"))
+        self.__indexed_databases.add(database_id)
+
     def get_relation_id(self, name, id, icon, properties={}):
         key = f"{id}{name}"
         if key in self.__cache:
             return self.__cache.get(key)
-        filter = {"property": "Title", "title": {"equals": name}}
-        response = self.client.databases.query(database_id=id, filter=filter)
+        # One lock per title so concurrent callers never create the same page twice
+        with self.__relation_lock:
+            lock = self.__relation_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key in self.__cache:
+                return self.__cache.get(key)
+            return self.__get_relation_id(key, name, id, icon, properties)
+
+    def __get_relation_id(self, key, name, id, icon, properties):
+        if id in self.__indexed_databases:
+            response = {"results": []}
+        else:
+            page_id = self.get_cached_relation(key)
+            if page_id is not None:
+                self.__cache[key] = page_id
+                return page_id
+            filter = {"property": "Title", "title": {"equals": name}}
+            response = self.client.databases.query(database_id=id, filter=filter)
         if len(response.get("results")) == 0:
             parent = {"database_id": id, "type": "database_id"}
-            properties["Title"] = get_title(name)
+            properties = {**properties, "Title": get_title(name)}
             page_id = self.client.pages.create(
                 parent=parent, properties=properties, icon=get_icon(icon)
             ).get("id")
         else:
             page_id = response.get("results")[0].get("id")
         self.__cache[key] = page_id
+        if self.relation_cache is not None:
+            self.relation_cache.put(key, page_id)
+        return page_id
+
+    def get_cached_relation(self, key):
+        """Return a relation page id persisted by an earlier run, checked once per process before use"""
+        if self.relation_cache is None:
+            return None
+        page_id = self.relation_cache.get(key)
+        if page_id is None or not self.relation_cache.needs_verification(key):
+            return page_id
+        try:
+            page = self.client.pages.retrieve(page_id)
+        except APIResponseError as e:
+            if e.code != APIErrorCode.ObjectNotFound:
+                raise
+            page = None
+        if page is None or page.get("archived") or page.get("in_trash"):
+            self.relation_cache.discard(key)
+            return None
+        self.relation_cache.verified(key)
         return page_id
 
     def insert_bookmark(self, id, bookmark):
@@ -348,10 +584,9 @@ class NotionHelper:
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.bookmark_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
     def insert_review(self, id, review):
-        time.sleep(0.1)
         icon = get_icon(TAG_ICON_URL)
         properties = {
             "Name": get_title(review.get("content", "")),
@@ -374,10 +609,9 @@ class NotionHelper:
             properties["Date"] = get_date(create_time.strftime("%Y-%m-%d %H:%M:%S"))
             self.get_date_relation(properties, create_time)
         parent = {"database_id": self.review_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
     def insert_chapter(self, id, chapter):
-        time.sleep(0.1)
         icon = {"type": "external", "external": {"url": TAG_ICON_URL}}
         properties = {
             "Name": get_title(chapter.get("title")),
@@ -390,118 +624,190 @@ class NotionHelper:
             "Books": {"relation": [{"id": id}]},
         }
         parent = {"database_id": self.chapter_database_id, "type": "database_id"}
-        self.create_page(parent, properties, icon)
+        return self.create_page(parent, properties, icon)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def update_book_page(self, page_id, properties):
         return self.client.pages.update(page_id=page_id, properties=properties)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def update_page(self, page_id, properties, cover):
+    def update_page(self, page_id, properties, cover=None, current=None, current_cover=None):
+        """Update a page; with current values ({name: get_diff_value}, e.g. Row.values) send only what changed"""
+        if current is not None:
+            properties = diff_properties(properties, current)
+            if cover is not None and get_diff_value(cover) == get_diff_value(
+                current_cover or {}
+            ):
+                cover = None
+            if not properties and cover is None:
+                with self.stats_lock:
+                    self.skipped_writes += 1
+                return {"id": page_id}
+        if cover is None:
+            return self.client.pages.update(page_id=page_id, properties=properties)
         return self.client.pages.update(
             page_id=page_id, properties=properties, cover=cover
         )
 
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_page(self, parent, properties, icon):
         return self.client.pages.create(parent=parent, properties=properties, icon=icon)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def create_book_page(self, parent, properties, icon):
         return self.client.pages.create(
             parent=parent, properties=properties, icon=icon, cover=icon
         )
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def query(self, **kwargs):
         kwargs = {k: v for k, v in kwargs.items() if v}
         return self.client.databases.query(**kwargs)
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_block_children(self, id):
         response = self.client.blocks.children.list(id)
+        self.cache_block_parents(response.get("results"))
         return response.get("results")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def append_blocks(self, block_id, children):
-        return self.client.blocks.children.append(block_id=block_id, children=children)
+        response = self.client.blocks.children.append(
+            block_id=block_id, children=children
+        )
+        self.cache_block_parents(response.get("results"))
+        return response
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def append_blocks_after(self, block_id, children, after):
         # Oddly, an extra child is inserted. Temporary fix by checking for parent.
-        parent = self.client.blocks.retrieve(after).get("parent")
+        parent = self.get_block_parent(after)
         if(parent.get("type")=="block_id"):
             after = parent.get("block_id")
-        return self.client.blocks.children.append(
+        response = self.client.blocks.children.append(
             block_id=block_id, children=children, after=after
         )
+        self.cache_block_parents(response.get("results"))
+        return response
+
+    def cache_block_parents(self, blocks):
+        for block in blocks:
+            if block.get("parent"):
+                self.block_parent_cache[block.get("id")] = block.get("parent")
+
+    def remember_page_blocks(self, page_id, block_ids):
+        """Record blocks known to be direct children of a page"""
+        for block_id in block_ids:
+            self.block_parent_cache[block_id] = {"type": "page_id", "page_id": page_id}
+
+    def get_block_parent(self, block_id):
+        parent = self.block_parent_cache.get(block_id)
+        if parent is None:
+            parent = self.client.blocks.retrieve(block_id).get("parent")
+            self.block_parent_cache[block_id] = parent
+        return parent
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def delete_block(self, block_id):
-        return self.client.blocks.delete(block_id=block_id)
+        """Delete a block or page; one already deleted or archived in Notion is skipped"""
+        try:
+            return self.client.blocks.delete(block_id=block_id)
+        except APIResponseError as e:
+            if e.code == APIErrorCode.ObjectNotFound or (
+                e.code == APIErrorCode.ValidationError and "archived" in str(e)
+            ):
+                print(f"Block {block_id} is already deleted in Notion.")
+                return None
+            raise
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
     def get_all_book(self):
         """Retrieve all books from Notion"""
-        results = self.query_all(self.book_database_id)
         books_dict = {}
-        for result in results:
-            bookId = get_property_value(result.get("properties").get("BookId"))
-            books_dict[bookId] = {
-                "pageId": result.get("id"),
-                "readingTime": get_property_value(
-                    result.get("properties").get("Reading Time")
-                ),
-                "category": get_property_value(
-                    result.get("properties").get("Bookshelf Category")
-                ),
-                "Sort": get_property_value(result.get("properties").get("Sort")),
-                "douban_url": get_property_value(
-                    result.get("properties").get("Douban Link")
-                ),
-                "cover": result.get("cover"),
-                "myRating": get_property_value(
-                    result.get("properties").get("My Rating")
-                ),
-                "comment": get_property_value(result.get("properties").get("Douban Comment")),
-                "status": get_property_value(result.get("properties").get("Reading Status")),
+        for row in self.iter_rows(self.book_database_id, BOOK_FIELDS, values=True):
+            books_dict[row.get("BookId")] = {
+                "pageId": row.id,
+                "readingTime": row.get("Reading Time"),
+                "category": row.get("Bookshelf Category"),
+                "Sort": row.get("Sort"),
+                "douban_url": row.get("Douban Link"),
+                "cover": row.cover,
+                "myRating": row.get("My Rating"),
+                "comment": row.get("Douban Comment"),
+                "status": row.get("Reading Status"),
+                "values": row.values,
             }
         return books_dict
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
-    def query_all_by_book(self, database_id, filter):
-        results = []
-        has_more = True
-        start_cursor = None
-        while has_more:
-            response = self.client.databases.query(
-                database_id=database_id,
-                filter=filter,
-                start_cursor=start_cursor,
-                page_size=100,
+    def cache_property_ids(self, database_id, database):
+        """Remember the property ids of a retrieved database"""
+        ids = {
+            name: unquote(x.get("id"))
+            for name, x in database.get("properties").items()
+        }
+        with self.__property_ids_lock:
+            self.__property_ids[database_id] = ids
+        return ids
+
+    def get_property_ids(self, database_id, names):
+        """Ids of the named properties, retrieving the schema once per database; unknown names are skipped"""
+        with self.__property_ids_lock:
+            ids = self.__property_ids.get(database_id)
+        if ids is None:
+            ids = self.cache_property_ids(
+                database_id, self.client.databases.retrieve(database_id=database_id)
+            )
+        return [ids[name] for name in names if name in ids]
+
+    def query_page(self, database_id, **kwargs):
+        """One page of a database query; transient failures are retried by the scheduler"""
+        return self.client.databases.query(
+            database_id=database_id, page_size=100, **kwargs
+        )
+
+    def iter_query(self, database_id, filter=None, start_cursor=None, properties=None):
+        """Yield the rows of a database query as each page arrives
+
+        A failed page is retried from its own start_cursor, never from the first page.
+
+        With properties, Notion only returns those properties of each row.
+        """
+        filter_properties = None
+        if properties:
+            filter_properties = self.get_property_ids(database_id, properties)
+        while True:
+            kwargs = {
+                "filter": filter,
+                "start_cursor": start_cursor,
+                "filter_properties": filter_properties,
+            }
+            response = self.query_page(
+                database_id, **{k: v for k, v in kwargs.items() if v}
             )
+            yield from response.get("results")
+            if not response.get("has_more"):
+                return
             start_cursor = response.get("next_cursor")
-            has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def iter_rows(self, database_id, fields, filter=None, values=False):
+        """Yield a compact Row per page of a query, keeping only the given properties"""
+        fields = {name: index for index, name in enumerate(fields)}
+        for result in self.iter_query(database_id, filter, properties=list(fields)):
+            properties = result.get("properties")
+            projected = [properties.get(name) for name in fields]
+            yield Row(
+                result.get("id"),
+                result.get("cover"),
+                fields,
+                tuple(
+                    None if x is None else get_property_value(x) for x in projected
+                ),
+                {
+                    name: get_diff_value(x)
+                    for name, x in zip(fields, projected)
+                    if x is not None
+                }
+                if values
+                else None,
+            )
+
+    def query_all_by_book(self, database_id, filter, properties=None):
+        return list(self.iter_query(database_id, filter, properties=properties))
+
     def query_all(self, database_id):
         """Retrieve all data from database"""
-        results = []
-        has_more = True
-        start_cursor = None
-        while has_more:
-            response = self.client.databases.query(
-                database_id=database_id,
-                start_cursor=start_cursor,
-                page_size=100,
-            )
-            start_cursor = response.get("next_cursor")
-            has_more = response.get("has_more")
-            results.extend(response.get("results"))
-        return results
+        return list(self.iter_query(database_id))
 
     def get_date_relation(self, properties, date):
         properties["Year"] = get_relation(
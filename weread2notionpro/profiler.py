@@ -0,0 +1,121 @@
+import collections
+import cProfile
+import functools
+import os
+import pstats
+import sys
+import threading
+
+# "cprofile" (or "1") for a deterministic profile, "sample" for wall-clock stack sampling
+PROFILE = os.getenv("WEREAD_PROFILE", "")
+PROFILE_DIR = os.getenv("WEREAD_PROFILE_DIR", ".")
+SAMPLE_INTERVAL = float(os.getenv("WEREAD_PROFILE_INTERVAL", "0.005"))
+NETWORK_FILES = ["socket.py", "ssl.py", "selectors.py", "connection.py", "client.py", "sync.py"]
+WAIT_FILES = ["threading.py", "queue.py", "thread.py", "scheduler.py"]
+
+
+def get_mode():
+    """Profiling mode from --profile[=sample] on the command line or WEREAD_PROFILE"""
+    for arg in sys.argv[1:]:
+        if arg == "--profile":
+            return "cprofile"
+        if arg.startswith("--profile="):
+            return arg.split("=", 1)[1]
+    if PROFILE == "1":
+        return "cprofile"
+    return PROFILE
+
+
+def profile(name):
+    """Run the decorated entry point under the profiler selected by get_mode()"""
+
+    def decorator(main):
+        @functools.wraps(main)
+        def wrapper(*args, **kwargs):
+            mode = get_mode()
+            if not mode:
+                return main(*args, **kwargs)
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            if mode == "sample":
+                sampler = Sampler()
+                sampler.start()
+                try:
+                    return main(*args, **kwargs)
+                finally:
+                    sampler.stop()
+                    sampler.report(os.path.join(PROFILE_DIR, f"{name}.folded"))
+            if mode != "cprofile":
+                raise Exception(f"Unknown profiling mode {mode}, use cprofile or sample.")
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(main, *args, **kwargs)
+            finally:
+                path = os.path.join(PROFILE_DIR, f"{name}.prof")
+                profiler.dump_stats(path)
+                print(f"Profile written to {path}")
+                pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
+
+        return wrapper
+
+    return decorator
+
+
+class Sampler:
+    """Samples the stacks of every thread at a fixed wall-clock interval"""
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {x.ident: x.name for x in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[tuple(reversed(stack))] += 1
+
+    def report(self, path):
+        """Write the stacks in folded format for flame graph tools and print a short summary"""
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+        total = sum(self.stacks.values())
+        if not total:
+            return
+        kinds = collections.Counter()
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            kinds[classify(stack[-1])] += count
+            leaves[stack[-1]] += count
+        print(f"Sampled stacks written to {path}")
+        for kind, count in kinds.most_common():
+            print(f"{kind:<10}{count * 100 / total:>6.1f}%")
+        for leaf, count in leaves.most_common(15):
+            print(f"{count * 100 / total:>6.1f}%  {leaf}")
+
+
+def classify(frame):
+    """Tell whether a sampled thread was on the network, waiting, or running Python code"""
+    file = frame.rsplit("(", 1)[-1].rstrip(")")
+    if file in NETWORK_FILES:
+        return "network"
+    if file in WAIT_FILES:
+        return "waiting"
+    return "cpu"
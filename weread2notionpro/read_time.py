@@ -1,11 +1,14 @@
-from datetime import datetime
-from datetime import timedelta
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 import pendulum
 
 from weread2notionpro.weread_api import WeReadApi
+from weread2notionpro.metrics import metrics
 from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.profiler import profile
+from weread2notionpro.state_store import open_state_store
 from weread2notionpro.utils import (
     format_date,
     get_date,
@@ -13,46 +16,26 @@ from weread2notionpro.utils import (
     get_number,
     get_relation,
     get_title,
+    timestamp_to_date,
 )
 
-def insert_to_notion(page_id, timestamp, duration):
+# Day properties written by insert_to_notion, the only ones read back from Notion
+DAY_FIELDS = ["Title", "Date", "Duration", "Timestamp", "Year", "Month", "Week"]
+
+def insert_to_notion(page_id, timestamp, duration, current=None):
     parent = {"database_id": notion_helper.day_database_id, "type": "database_id"}
+    date = timestamp_to_date(timestamp)
     properties = {
-        "Title": get_title(
-            format_date(
-                datetime.utcfromtimestamp(timestamp) + timedelta(hours=8),
-                "%Y-%m-%d",
-            )
-        ),
-        "Date": get_date(
-            start=format_date(datetime.utcfromtimestamp(timestamp) + timedelta(hours=8))
-        ),
+        "Title": get_title(format_date(date, "%Y-%m-%d")),
+        "Date": get_date(start=format_date(date)),
         "Duration": get_number(duration),
         "Timestamp": get_number(timestamp),
-        "Year": get_relation(
-            [
-                notion_helper.get_year_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
-        "Month": get_relation(
-            [
-                notion_helper.get_month_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
-        "Week": get_relation(
-            [
-                notion_helper.get_week_relation_id(
-                    datetime.utcfromtimestamp(timestamp) + timedelta(hours=8)
-                ),
-            ]
-        ),
+        "Year": get_relation([notion_helper.get_year_relation_id(date)]),
+        "Month": get_relation([notion_helper.get_month_relation_id(date)]),
+        "Week": get_relation([notion_helper.get_week_relation_id(date)]),
     }
     if page_id != None:
-        notion_helper.client.pages.update(page_id=page_id, properties=properties)
+        notion_helper.update_page(page_id, properties, current=current)
     else:
         notion_helper.client.pages.create(
             parent=parent,
@@ -60,6 +43,32 @@ def insert_to_notion(page_id, timestamp, duration):
             properties=properties,
         )
 
+def backfill(read_times):
+    """Create every missing Year/Month/Week page first, then write the day rows concurrently"""
+    for database_id in [
+        notion_helper.year_database_id,
+        notion_helper.month_database_id,
+        notion_helper.week_database_id,
+    ]:
+        notion_helper.load_relation_index(database_id)
+    buckets = {}
+    for timestamp in read_times:
+        date = timestamp_to_date(timestamp)
+        year, week, _ = date.isocalendar()
+        buckets.setdefault(("year", date.year), (notion_helper.get_year_relation_id, date))
+        buckets.setdefault(
+            ("month", date.year, date.month), (notion_helper.get_month_relation_id, date)
+        )
+        buckets.setdefault(("week", year, week), (notion_helper.get_week_relation_id, date))
+    print(f"Backfilling {len(read_times)} days in {len(buckets)} calendar pages.")
+    with ThreadPoolExecutor(max_workers=BACKFILL_WORKERS) as executor:
+        list(executor.map(lambda x: x[0](x[1]), buckets.values()))
+        list(
+            executor.map(
+                lambda x: insert_to_notion(None, int(x[0]), x[1]), read_times.items()
+            )
+        )
+
 def get_file():
     # Set folder path
     folder_path = "./OUT_FOLDER"
@@ -74,18 +83,26 @@ def get_file():
         print("OUT_FOLDER does not exist.")
         return None
 
+# Switch to backfill() when at least this many days are missing, e.g. for a new user
+BACKFILL_THRESHOLD = int(os.getenv("READ_TIME_BACKFILL_THRESHOLD", "30"))
+BACKFILL_WORKERS = int(os.getenv("NOTION_WORKERS", "4"))
 HEATMAP_GUIDE = "https://mp.weixin.qq.com/s?__biz=MzI1OTcxOTI4NA==&mid=2247484145&idx=1&sn=81752852420b9153fc292b7873217651&chksm=ea75ebeadd0262fc65df100370d3f983ba2e52e2fcde2deb1ed49343fbb10645a77570656728&token=157143379&lang=en_US#rd"
 
 notion_helper = NotionHelper()
-weread_api = WeReadApi()
+weread_api = WeReadApi(open_state_store())
+@profile("read_time")
 def main():
+    atexit.register(metrics.report, "read_time")
+    weread_api.start()
+    notion_helper.start()
     image_file = get_file()
     if image_file:
         image_url = f"https://raw.githubusercontent.com/{os.getenv('REPOSITORY')}/{os.getenv('REF').split('/')[-1]}/OUT_FOLDER/{image_file}"
         heatmap_url = f"https://heatmap.malinkang.com/?image={image_url}"
-        if notion_helper.heatmap_block_id:
+        heatmap_block_id = notion_helper.get_heatmap_block_id()
+        if heatmap_block_id:
             response = notion_helper.update_heatmap(
-                block_id=notion_helper.heatmap_block_id, url=heatmap_url
+                block_id=heatmap_block_id, url=heatmap_url
             )
         else:
             print(f"Failed to update heatmap, placeholder missing. Refer to: {HEATMAP_GUIDE}")
@@ -98,16 +115,26 @@ def main():
     if today_timestamp not in readTimes:
         readTimes[today_timestamp] = 0
     readTimes = dict(sorted(readTimes.items()))
-    results = notion_helper.query_all(database_id=notion_helper.day_database_id)
-    for result in results:
-        timestamp = result.get("properties").get("Timestamp").get("number")
-        duration = result.get("properties").get("Duration").get("number")
-        id = result.get("id")
+    # Read every page before writing, so updates cannot shift the pagination
+    rows = list(
+        notion_helper.iter_rows(notion_helper.day_database_id, DAY_FIELDS, values=True)
+    )
+    for row in rows:
+        timestamp = row.get("Timestamp")
         if timestamp in readTimes:
             value = readTimes.pop(timestamp)
-            if value != duration:
-                insert_to_notion(page_id=id, timestamp=timestamp, duration=value)
-    for key, value in readTimes.items():
-        insert_to_notion(None, int(key), value)
+            if value != row.get("Duration"):
+                insert_to_notion(
+                    page_id=row.id,
+                    timestamp=timestamp,
+                    duration=value,
+                    current=row.values,
+                )
+    if len(readTimes) >= BACKFILL_THRESHOLD:
+        backfill(readTimes)
+    else:
+        for key, value in readTimes.items():
+            insert_to_notion(None, int(key), value)
+    print(f"Skipped {notion_helper.skipped_writes} unchanged Notion writes.")
 if __name__ == "__main__":
     main()
@@ -0,0 +1,95 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+
+RELATION_CACHE = os.getenv("NOTION_RELATION_CACHE")
+RELATION_CACHE_TTL = int(os.getenv("NOTION_RELATION_CACHE_TTL", str(7 * 24 * 3600)))
+RELATION_CACHE_SIZE = int(os.getenv("NOTION_RELATION_CACHE_SIZE", "10000"))
+
+
+class RelationCache:
+    """Relation page ids persisted in a JSON file between runs, with TTL and LRU eviction"""
+
+    def __init__(self, path, ttl=RELATION_CACHE_TTL, max_size=RELATION_CACHE_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> [page_id, stored_at], least recently used first
+        self.entries = OrderedDict()
+        # Keys whose page was checked to still exist by this process
+        self.verified_keys = set()
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = None
+        if not isinstance(entries, list) or not all(is_entry(x) for x in entries):
+            print(f"Ignoring unreadable relation cache {self.path}")
+            return
+        now = time.time()
+        for key, entry in entries:
+            if now - entry[1] < self.ttl:
+                self.entries[key] = entry[:2]
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            entries = list(self.entries.items())
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] >= self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def needs_verification(self, key):
+        """A cached page is checked once per process before it is first handed out"""
+        with self.lock:
+            return key in self.entries and key not in self.verified_keys
+
+    def verified(self, key):
+        with self.lock:
+            self.verified_keys.add(key)
+
+    def put(self, key, page_id):
+        now = time.time()
+        with self.lock:
+            self.entries[key] = [page_id, now]
+            self.verified_keys.add(key)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.verified_keys.discard(key)
+
+
+def is_entry(x):
+    """[key, [page_id, stored_at, ...]] as written by RelationCache.save"""
+    return (
+        isinstance(x, list)
+        and len(x) == 2
+        and isinstance(x[0], str)
+        and isinstance(x[1], list)
+        and len(x[1]) >= 2
+        and isinstance(x[1][0], str)
+        and isinstance(x[1][1], (int, float))
+    )
@@ -0,0 +1,136 @@
+import os
+import random
+import threading
+import time
+
+import httpx
+from notion_client import Client
+from notion_client.errors import HTTPResponseError, RequestTimeoutError
+
+from weread2notionpro.metrics import endpoint_name, metrics
+
+# Notion allows an average of three requests per second per integration
+# https://developers.notion.com/reference/request-limits
+NOTION_RATE_LIMIT = float(os.getenv("NOTION_RATE_LIMIT", "3"))
+NOTION_BURST = int(os.getenv("NOTION_BURST", "3"))
+NOTION_MAX_ATTEMPTS = int(os.getenv("NOTION_MAX_ATTEMPTS", "5"))
+RETRYABLE_STATUS = [409, 429, 500, 502, 503, 504]
+
+
+class NotionScheduler:
+    """Token bucket shared by every Notion request in the process"""
+
+    def __init__(
+        self, rate=NOTION_RATE_LIMIT, burst=NOTION_BURST, max_attempts=NOTION_MAX_ATTEMPTS
+    ):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.max_attempts = max_attempts
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and no Retry-After window is open"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                wait = self.blocked_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            metrics.count("notion_throttled_seconds", wait)
+
+    def block(self, seconds):
+        """Pause all callers, e.g. for the Retry-After of a 429 response"""
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def call(self, fn, *args, **kwargs):
+        attempt = 1
+        while True:
+            self.acquire()
+            try:
+                return fn(*args, **kwargs)
+            except (HTTPResponseError, RequestTimeoutError, httpx.TransportError) as e:
+                if not is_transient(e) or attempt >= self.max_attempts:
+                    raise
+                if getattr(e, "status", None) == 429:
+                    metrics.count("notion_rate_limited")
+                    self.block(retry_after(e.headers, attempt))
+                else:
+                    self.sleep(backoff(attempt))
+            attempt += 1
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        metrics.count("notion_throttled_seconds", seconds)
+
+
+def is_transient(e):
+    """Whether a failed Notion request is worth sending again"""
+    if isinstance(e, HTTPResponseError):
+        return e.status in RETRYABLE_STATUS
+    return isinstance(e, (RequestTimeoutError, httpx.TransportError))
+
+
+def retry_after(headers, attempt):
+    """Seconds to wait from a Retry-After header, falling back to exponential backoff"""
+    try:
+        return max(float(headers.get("Retry-After")), 0)
+    except (TypeError, ValueError):
+        return backoff(attempt)
+
+
+def backoff(attempt):
+    return min(0.5 * 2 ** (attempt - 1), 8) + random.uniform(0, 0.25)
+
+
+scheduler = NotionScheduler()
+
+
+class ScheduledClient(Client):
+    """Notion client whose requests all go through a NotionScheduler"""
+
+    def __init__(self, scheduler=scheduler, **kwargs):
+        super().__init__(**kwargs)
+        self.scheduler = scheduler
+        self.local = threading.local()
+
+    def request(self, path, method, query=None, body=None, auth=None):
+        endpoint = endpoint_name(method, path)
+        attempts = []
+
+        def send():
+            self.local.bytes = 0
+            error = True
+            start = time.perf_counter()
+            try:
+                response = Client.request(self, path, method, query, body, auth)
+                error = False
+                return response
+            finally:
+                metrics.record(
+                    "notion",
+                    endpoint,
+                    time.perf_counter() - start,
+                    self.local.bytes,
+                    error,
+                    retry=bool(attempts),
+                )
+                attempts.append(error)
+
+        return self.scheduler.call(send)
+
+    def _parse_response(self, response):
+        self.local.bytes = len(response.request.content) + len(response.content)
+        return super()._parse_response(response)
@@ -0,0 +1,180 @@
+import json
+import os
+import sqlite3
+import threading
+
+from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.utils import get_rich_text_from_result, get_number_from_result
+
+STATE_DB = os.getenv("WEREAD_STATE_DB", "weread_state.db")
+BOOKMARK = "bookmark"
+REVIEW = "review"
+CHAPTER = "chapter"
+
+
+class SyncStateStore:
+    """Local SQLite copy of the WeRead ID -> Notion blockId/pageId mappings of every book"""
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.__conn = None
+
+    @property
+    def conn(self):
+        """Open the database on first use so creating a store touches no files"""
+        if self.__conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS mappings (
+                    kind TEXT NOT NULL,
+                    book_page_id TEXT NOT NULL,
+                    weread_id NOT NULL,
+                    block_id TEXT,
+                    page_id TEXT,
+                    PRIMARY KEY (kind, book_page_id, weread_id)
+                );
+                CREATE TABLE IF NOT EXISTS books (
+                    kind TEXT NOT NULL,
+                    book_page_id TEXT NOT NULL,
+                    PRIMARY KEY (kind, book_page_id)
+                );
+                CREATE TABLE IF NOT EXISTS sync_keys (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    synckey NOT NULL,
+                    payload TEXT NOT NULL,
+                    PRIMARY KEY (kind, key)
+                );
+                """
+            )
+            self.__conn = conn
+        return self.__conn
+
+    def has_book(self, kind, book_page_id):
+        """Whether the mappings of this book were loaded from Notion before"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM books WHERE kind = ? AND book_page_id = ?",
+                (kind, book_page_id),
+            ).fetchone()
+        return row is not None
+
+    def get_mappings(self, kind, book_page_id):
+        """Return {weread_id: (block_id, page_id)}"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT weread_id, block_id, page_id FROM mappings"
+                " WHERE kind = ? AND book_page_id = ?",
+                (kind, book_page_id),
+            ).fetchall()
+        return {weread_id: (block_id, page_id) for weread_id, block_id, page_id in rows}
+
+    def replace_book(self, kind, book_page_id, mappings):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM mappings WHERE kind = ? AND book_page_id = ?",
+                (kind, book_page_id),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?)",
+                [
+                    (kind, book_page_id, weread_id, block_id, page_id)
+                    for weread_id, (block_id, page_id) in mappings.items()
+                ],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO books VALUES (?, ?)", (kind, book_page_id)
+            )
+
+    def put(self, kind, book_page_id, weread_id, block_id, page_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO mappings VALUES (?, ?, ?, ?, ?)",
+                (kind, book_page_id, weread_id, block_id, page_id),
+            )
+
+    def delete(self, kind, book_page_id, weread_id):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM mappings WHERE kind = ? AND book_page_id = ? AND weread_id = ?",
+                (kind, book_page_id, weread_id),
+            )
+
+    def get_sync(self, kind, key):
+        """Return (synckey, payload) of the last WeRead sync of this endpoint, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT synckey, payload FROM sync_keys WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put_sync(self, kind, key, synckey, payload):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sync_keys VALUES (?, ?, ?, ?)",
+                (kind, key, synckey, json.dumps(payload, ensure_ascii=False)),
+            )
+
+    def clear(self):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM mappings")
+            self.conn.execute("DELETE FROM books")
+
+
+def open_state_store():
+    """Open the store unless WEREAD_STATE_DB is set to an empty value"""
+    if not STATE_DB:
+        return None
+    return SyncStateStore(STATE_DB)
+
+
+def group_by_book(results, kind, id_name):
+    """Group Highlights/Notes/Chapters rows into {book_page_id: {weread_id: (blockId, pageId)}}"""
+    books = {}
+    for result in results:
+        properties = result.get("properties")
+        relation = properties.get("Books").get("relation")
+        if not relation or not properties.get("blockId").get("rich_text"):
+            continue
+        if kind == CHAPTER:
+            weread_id = get_number_from_result(result, id_name)
+        else:
+            weread_id = get_rich_text_from_result(result, id_name)
+        books.setdefault(relation[0].get("id"), {})[weread_id] = (
+            get_rich_text_from_result(result, "blockId"),
+            result.get("id"),
+        )
+    return books
+
+
+def rebuild(store, notion_helper):
+    """Rebuild the whole store with one scan of each Notion database"""
+    store.clear()
+    book_page_ids = [x.get("pageId") for x in notion_helper.get_all_book().values()]
+    for kind, database_id, id_name in [
+        (BOOKMARK, notion_helper.bookmark_database_id, "bookmarkId"),
+        (REVIEW, notion_helper.review_database_id, "reviewId"),
+        (CHAPTER, notion_helper.chapter_database_id, "chapterUid"),
+    ]:
+        books = group_by_book(notion_helper.iter_query(database_id), kind, id_name)
+        for book_page_id in set(book_page_ids) | set(books):
+            store.replace_book(kind, book_page_id, books.get(book_page_id, {}))
+        print(f"Rebuilt {kind} mappings for {len(books)} books.")
+
+
+def main():
+    store = open_state_store()
+    if store is None:
+        print("WEREAD_STATE_DB is empty, nothing to rebuild.")
+        return
+    rebuild(store, NotionHelper().start())
+    print(f"Sync state rebuilt at {store.path}")
+
+
+if __name__ == "__main__":
+    main()
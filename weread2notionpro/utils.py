@@ -1,10 +1,14 @@
 import calendar
 from datetime import datetime
 from datetime import timedelta
+from email.utils import formatdate, parsedate_to_datetime
 import hashlib
+import json
 import os
 import re
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 import base64
 from weread2notionpro.config import (
     RICH_TEXT,
@@ -100,7 +104,7 @@ def get_quote(content):
         },
     }
 
-def get_block(content, block_type, show_color, style, colorStyle, reviewId):
+def get_block(content, block_type, show_color, style, colorStyle, reviewId, abstract=None):
     color = "default"
     if show_color:
         if colorStyle == 1:
@@ -136,6 +140,9 @@ def get_block(content, block_type, show_color, style, colorStyle, reviewId):
         if reviewId is not None:
             emoji = "✍️"
         block[block_type]["icon"] = {"emoji": emoji}
+    if abstract:
+        # Nest the quoted abstract so the block and its quote go out in one request
+        block[block_type]["children"] = [get_quote(abstract)]
     return block
 
 def get_rich_text_from_result(result, name):
@@ -249,19 +256,126 @@ def get_property_value(property):
     else:
         return content
 
+def get_diff_value(property):
+    """Comparable value of a property, either from a Notion response or from a payload we built"""
+    type = property.get("type") or next(iter(property), None)
+    content = property.get(type)
+    if content is None:
+        return None
+    if type == "title" or type == "rich_text":
+        return "".join(
+            x.get("plain_text") or x.get("text", {}).get("content", "") for x in content
+        )
+    elif type == "status" or type == "select":
+        return content.get("name")
+    elif type == "multi_select":
+        return sorted(x.get("name") for x in content)
+    elif type == "relation":
+        return sorted(x.get("id").replace("-", "") for x in content)
+    elif type == "files":
+        return [x.get(x.get("type"), {}).get("url") for x in content]
+    elif type == "date":
+        tz = content.get("time_zone") or "UTC"
+        return [
+            None if x is None else int(pendulum.parse(x, tz=tz).timestamp())
+            for x in (content.get("start"), content.get("end"))
+        ]
+    else:
+        return content
+
+def diff_properties(properties, current):
+    """Keep only the properties whose value differs from current (name -> get_diff_value)"""
+    return {
+        key: value
+        for key, value in properties.items()
+        if key not in current or get_diff_value(value) != current.get(key)
+    }
+
 def str_to_timestamp(date):
     if date is None:
         return 0
     dt = pendulum.parse(date)
     return int(dt.timestamp())
 
-upload_url = "https://wereadassets.malinkang.com/"
+upload_url = os.getenv("COVER_UPLOAD_URL", "https://wereadassets.malinkang.com/")
+# Pooled connections to the cover hosts; covers are mirrored on book.py's prefetch threads
+COVER_WORKERS = int(os.getenv("COVER_WORKERS", "8"))
+COVER_TIMEOUT = float(os.getenv("COVER_TIMEOUT", "30"))
+CHUNK_SIZE = 64 * 1024
+# Multiple of 3 so every chunk base64-encodes without padding
+UPLOAD_CHUNK_SIZE = 3 * 16 * 1024
+cover_session = requests.Session()
+cover_session.mount("https://", HTTPAdapter(pool_maxsize=COVER_WORKERS))
+cover_session.mount("http://", HTTPAdapter(pool_maxsize=COVER_WORKERS))
+uploads_lock = threading.Lock()
+upload_locks = {}
+
+class Base64JsonBody:
+    """{"file": <base64 of a file>, ...} streamed from disk with a known Content-Length"""
+
+    def __init__(self, file_path, fields):
+        self.file_path = file_path
+        self.prefix = json.dumps(fields)[:-1].encode() + b', "file": "'
+        self.suffix = b'"}'
+        size = os.path.getsize(file_path)
+        self.length = len(self.prefix) + (size + 2) // 3 * 4 + len(self.suffix)
+
+    def __len__(self):
+        return self.length
 
-def upload_image(folder_path, filename, file_path):
+    def __iter__(self):
+        yield self.prefix
+        with open(self.file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b""):
+                yield base64.b64encode(chunk)
+        yield self.suffix
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
     with open(file_path, "rb") as file:
-        content_base64 = base64.b64encode(file.read()).decode("utf-8")
-    data = {"file": content_base64, "filename": filename, "folder": folder_path}
-    response = requests.post(upload_url, json=data)
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def load_uploads(save_dir):
+    """{sha256 of a file: upload response} of covers uploaded before"""
+    path = os.path.join(save_dir, "uploads.json")
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_uploads(save_dir, uploads):
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, "uploads.json")
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(uploads, f)
+    os.replace(f"{path}.tmp", path)
+
+def upload_image(folder_path, filename, file_path, uploads=None):
+    """Upload a file, streaming its base64; files whose content is in uploads are not sent again"""
+    digest = file_sha256(file_path) if uploads is not None else None
+    if digest is not None:
+        # One upload per content hash, even when several threads mirror the same cover
+        with uploads_lock:
+            lock = upload_locks.setdefault(digest, threading.Lock())
+        with lock:
+            if digest in uploads:
+                return uploads[digest]
+            result = upload_image(folder_path, filename, file_path)
+            if result is not None:
+                uploads[digest] = result
+            return result
+    body = Base64JsonBody(file_path, {"filename": filename, "folder": folder_path})
+    response = requests.post(
+        upload_url,
+        data=body,
+        headers={"Content-Type": "application/json"},
+        timeout=COVER_TIMEOUT,
+    )
     if response.status_code == 200:
         print("File uploaded successfully.")
         return response.text
@@ -275,22 +389,53 @@ def url_to_md5(url):
     return md5_hash.hexdigest()
 
 def download_image(url, save_dir="cover"):
+    """Download to save_dir, revalidating an existing file with its ETag and modification time"""
     if not os.path.exists(save_dir):
-        os.makedirs(save_dir)
+        os.makedirs(save_dir, exist_ok=True)
     file_name = url_to_md5(url) + ".jpg"
     save_path = os.path.join(save_dir, file_name)
+    etag_path = f"{save_path}.etag"
+    headers = {}
     if os.path.exists(save_path):
-        print(f"File {file_name} already exists. Skipping download.")
+        headers["If-Modified-Since"] = formatdate(os.path.getmtime(save_path), usegmt=True)
+        if os.path.exists(etag_path):
+            with open(etag_path) as f:
+                headers["If-None-Match"] = f.read()
+    try:
+        response = cover_session.get(url, headers=headers, stream=True, timeout=COVER_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Failed to download image {url}: {e}")
         return save_path
-    response = requests.get(url, stream=True)
-    if response.status_code == 200:
-        with open(save_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=128):
+    with response:
+        if response.status_code == 304:
+            print(f"File {file_name} is up to date. Skipping download.")
+            return save_path
+        if response.status_code != 200:
+            print(f"Failed to download image. Status code: {response.status_code}")
+            return save_path
+        tmp_path = f"{save_path}.tmp"
+        with open(tmp_path, "wb") as file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                 file.write(chunk)
-        print(f"Image downloaded successfully to {save_path}")
-    else:
-        print(f"Failed to download image. Status code: {response.status_code}")
+        os.replace(tmp_path, save_path)
+    if response.headers.get("ETag"):
+        with open(etag_path, "w") as f:
+            f.write(response.headers.get("ETag"))
+    if response.headers.get("Last-Modified"):
+        try:
+            modified = parsedate_to_datetime(response.headers.get("Last-Modified")).timestamp()
+            os.utime(save_path, (modified, modified))
+        except (TypeError, ValueError):
+            pass
+    print(f"Image downloaded successfully to {save_path}")
     return save_path
 
+def mirror_cover(url, uploads, folder_path="cover", save_dir="cover"):
+    """Download a cover and upload it once per content hash; return the upload response"""
+    save_path = download_image(url, save_dir)
+    if not os.path.exists(save_path):
+        return None
+    return upload_image(folder_path, os.path.basename(save_path), save_path, uploads)
+
 def get_embed(url):
     return {"type": "embed", "embed": {"url": url}}
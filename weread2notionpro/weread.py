@@ -1,4 +1,11 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+
+from weread2notionpro.metrics import metrics
 from weread2notionpro.notion_helper import NotionHelper
+from weread2notionpro.profiler import profile
+from weread2notionpro.state_store import BOOKMARK, CHAPTER, REVIEW, open_state_store
 from weread2notionpro.weread_api import WeReadApi
 
 from weread2notionpro.utils import (
@@ -6,11 +13,40 @@ from weread2notionpro.utils import (
     get_heading,
     get_number,
     get_number_from_result,
-    get_quote,
     get_rich_text_from_result,
     get_table_of_contents,
 )
 
+# Number of Highlights/Notes/Chapters pages created concurrently, all sharing one Notion rate budget
+NOTION_WORKERS = int(os.getenv("NOTION_WORKERS", "4"))
+
+def load_block_mapping(kind, page_id, database_id, filter, id_name):
+    """Return {weread id: (blockId, pageId)} of a book, from the state store when it has the book"""
+    if state_store is not None and state_store.has_book(kind, page_id):
+        mapping = state_store.get_mappings(kind, page_id)
+    else:
+        results = notion_helper.query_all_by_book(
+            database_id, filter, properties=[id_name, "blockId"]
+        )
+        get_id = get_number_from_result if kind == CHAPTER else get_rich_text_from_result
+        mapping = {
+            get_id(x, id_name): (get_rich_text_from_result(x, "blockId"), x.get("id"))
+            for x in results
+        }
+        if state_store is not None:
+            state_store.replace_book(kind, page_id, mapping)
+    # Synced blocks are appended at the top level of the book page
+    notion_helper.remember_page_blocks(page_id, [x[0] for x in mapping.values()])
+    return mapping
+
+def delete_blocks(kind, page_id, mapping):
+    """Delete blocks and database pages that no longer exist in WeRead"""
+    for weread_id, (blockId, id) in mapping.items():
+        notion_helper.delete_block(blockId)
+        notion_helper.delete_block(id)
+        if state_store is not None:
+            state_store.delete(kind, page_id, weread_id)
+
 def get_bookmark_list(page_id, bookId):
     """Get my highlights"""
     filter = {
@@ -19,23 +55,14 @@ def get_bookmark_list(page_id, bookId):
             {"property": "blockId", "rich_text": {"is_not_empty": True}},
         ]
     }
-    results = notion_helper.query_all_by_book(
-        notion_helper.bookmark_database_id, filter
+    mapping = load_block_mapping(
+        BOOKMARK, page_id, notion_helper.bookmark_database_id, filter, "bookmarkId"
     )
-    dict1 = {
-        get_rich_text_from_result(x, "bookmarkId"): get_rich_text_from_result(
-            x, "blockId"
-        )
-        for x in results
-    }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
     bookmarks = weread_api.get_bookmark_list(bookId)
     for i in bookmarks:
-        if i.get("bookmarkId") in dict1:
-            i["blockId"] = dict1.pop(i.get("bookmarkId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
+        if i.get("bookmarkId") in mapping:
+            i["blockId"] = mapping.pop(i.get("bookmarkId"))[0]
+    delete_blocks(BOOKMARK, page_id, mapping)
     return bookmarks
 
 def get_review_list(page_id, bookId):
@@ -46,21 +73,14 @@ def get_review_list(page_id, bookId):
             {"property": "blockId", "rich_text": {"is_not_empty": True}},
         ]
     }
-    results = notion_helper.query_all_by_book(notion_helper.review_database_id, filter)
-    dict1 = {
-        get_rich_text_from_result(x, "reviewId"): get_rich_text_from_result(
-            x, "blockId"
-        )
-        for x in results
-    }
-    dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
+    mapping = load_block_mapping(
+        REVIEW, page_id, notion_helper.review_database_id, filter, "reviewId"
+    )
     reviews = weread_api.get_review_list(bookId)
     for i in reviews:
-        if i.get("reviewId") in dict1:
-            i["blockId"] = dict1.pop(i.get("reviewId"))
-    for blockId in dict1.values():
-        notion_helper.delete_block(blockId)
-        notion_helper.delete_block(dict2.get(blockId))
+        if i.get("reviewId") in mapping:
+            i["blockId"] = mapping.pop(i.get("reviewId"))[0]
+    delete_blocks(REVIEW, page_id, mapping)
     return reviews
 
 def check(bookId):
@@ -107,16 +127,9 @@ def sort_notes(page_id, chapter, bookmark_list):
     notes = []
     if chapter is not None:
         filter = {"property": "Books", "relation": {"contains": page_id}}
-        results = notion_helper.query_all_by_book(
-            notion_helper.chapter_database_id, filter
+        mapping = load_block_mapping(
+            CHAPTER, page_id, notion_helper.chapter_database_id, filter, "chapterUid"
         )
-        dict1 = {
-            get_number_from_result(x, "chapterUid"): get_rich_text_from_result(
-                x, "blockId"
-            )
-            for x in results
-        }
-        dict2 = {get_rich_text_from_result(x, "blockId"): x.get("id") for x in results}
         d = {}
         for data in bookmark_list:
             chapterUid = data.get("chapterUid", 1)
@@ -125,13 +138,11 @@ def sort_notes(page_id, chapter, bookmark_list):
             d[chapterUid].append(data)
         for key, value in d.items():
             if key in chapter:
-                if key in dict1:
-                    chapter.get(key)["blockId"] = dict1.pop(key)
+                if key in mapping:
+                    chapter.get(key)["blockId"] = mapping.pop(key)[0]
                 notes.append(chapter.get(key))
             notes.extend(value)
-        for blockId in dict1.values():
-            notion_helper.delete_block(blockId)
-            notion_helper.delete_block(dict2.get(blockId))
+        delete_blocks(CHAPTER, page_id, mapping)
     else:
         notes.extend(bookmark_list)
     return notes
@@ -177,14 +188,45 @@ def append_blocks(id, contents):
 
     if len(blocks) > 0:
         l.extend(append_blocks_to_notion(id, blocks, before_block_id, sub_contents))
-    for index, value in enumerate(l):
-        print(f"Inserting note {index + 1} of {len(l)}")
-        if "bookmarkId" in value:
-            notion_helper.insert_bookmark(id, value)
-        elif "reviewId" in value:
-            notion_helper.insert_review(id, value)
-        else:
-            notion_helper.insert_chapter(id, value)
+    return insert_index_pages(id, l)
+
+def insert_index_page(id, value):
+    """Create the Highlights, Notes or Chapters database page of an appended block"""
+    if "bookmarkId" in value:
+        kind, weread_id = BOOKMARK, value.get("bookmarkId")
+        result = notion_helper.insert_bookmark(id, value)
+    elif "reviewId" in value:
+        kind, weread_id = REVIEW, value.get("reviewId")
+        result = notion_helper.insert_review(id, value)
+    else:
+        kind, weread_id = CHAPTER, value.get("chapterUid")
+        result = notion_helper.insert_chapter(id, value)
+    if state_store is not None:
+        state_store.put(kind, id, weread_id, value.get("blockId"), result.get("id"))
+
+def insert_index_pages(id, contents):
+    """Create index pages on a bounded pool, retrying the failed ones once; return what still failed"""
+    failed = []
+    with ThreadPoolExecutor(max_workers=NOTION_WORKERS) as executor:
+        futures = {
+            executor.submit(insert_index_page, id, value): value for value in contents
+        }
+        for index, future in enumerate(as_completed(futures)):
+            print(f"Inserting note {index + 1} of {len(contents)}")
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to insert note {futures[future].get('blockId')}: {e}")
+                failed.append(futures[future])
+    errors = []
+    for value in failed:
+        try:
+            insert_index_page(id, value)
+        except Exception as e:
+            errors.append(f"{value.get('blockId')}: {e}")
+    if errors:
+        print(f"Failed to insert {len(errors)} notes: {errors}")
+    return errors
 
 def content_to_block(content):
     if "bookmarkId" in content:
@@ -195,6 +237,7 @@ def content_to_block(content):
             content.get("style"),
             content.get("colorStyle"),
             content.get("reviewId"),
+            content.get("abstract"),
         )
     elif "reviewId" in content:
         return get_block(
@@ -204,6 +247,7 @@ def content_to_block(content):
             content.get("style"),
             content.get("colorStyle"),
             content.get("reviewId"),
+            content.get("abstract"),
         )
     else:
         return get_heading(content.get("level"), content.get("title"))
@@ -216,17 +260,18 @@ def append_blocks_to_notion(id, blocks, after, contents):
     l = []
     for index, content in enumerate(contents):
         result = results[index]
-        if content.get("abstract") is not None and content.get("abstract") != "":
-            notion_helper.append_blocks(
-                block_id=result.get("id"), children=[get_quote(content.get("abstract"))]
-            )
         content["blockId"] = result.get("id")
         l.append(content)
     return l
 
-weread_api = WeReadApi()
+state_store = open_state_store()
+weread_api = WeReadApi(state_store)
 notion_helper = NotionHelper()
+@profile("weread")
 def main():
+    atexit.register(metrics.report, "weread")
+    weread_api.start()
+    notion_helper.start()
     notion_books = notion_helper.get_all_book()
     books = weread_api.get_notebooklist()
     if books != None:
@@ -245,7 +290,9 @@ def main():
             reviews = get_review_list(pageId,bookId)
             bookmark_list.extend(reviews)
             content = sort_notes(pageId, chapter, bookmark_list)
-            append_blocks(pageId, content)
+            if append_blocks(pageId, content):
+                # Leave Sort unchanged so the book is synchronized again next run
+                continue
             properties = {
                 "Sort":get_number(sort)
             }
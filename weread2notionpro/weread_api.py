@@ -1,31 +1,183 @@
+import functools
 import hashlib
 import json
 import os
 import re
+import threading
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.utils import cookiejar_from_dict
 from retrying import retry
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
 from dotenv import load_dotenv
 
+from weread2notionpro.cassette import CassetteAdapter, get_cassette
+from weread2notionpro.metrics import endpoint_name, metrics
+
 load_dotenv()
-WEREAD_URL = "https://weread.qq.com/"
-WEREAD_NOTEBOOKS_URL = "https://i.weread.qq.com/user/notebooks"
-WEREAD_BOOKMARKLIST_URL = "https://i.weread.qq.com/book/bookmarklist"
-WEREAD_CHAPTER_INFO = "https://i.weread.qq.com/book/chapterInfos"
-WEREAD_READ_INFO_URL = "https://i.weread.qq.com/book/readinfo"
-WEREAD_REVIEW_LIST_URL = "https://i.weread.qq.com/review/list"
-WEREAD_BOOK_INFO = "https://i.weread.qq.com/book/info"
-WEREAD_READDATA_DETAIL = "https://i.weread.qq.com/readdata/detail"
-WEREAD_HISTORY_URL = "https://i.weread.qq.com/readdata/summary?synckey=0"
+# Both hosts can be pointed at a local stand-in, see benchmarks/
+WEREAD_URL = os.getenv("WEREAD_URL", "https://weread.qq.com/")
+WEREAD_API_URL = os.getenv("WEREAD_API_URL", "https://i.weread.qq.com")
+WEREAD_NOTEBOOKS_URL = f"{WEREAD_API_URL}/user/notebooks"
+WEREAD_BOOKMARKLIST_URL = f"{WEREAD_API_URL}/book/bookmarklist"
+WEREAD_CHAPTER_INFO = f"{WEREAD_API_URL}/book/chapterInfos"
+WEREAD_READ_INFO_URL = f"{WEREAD_API_URL}/book/readinfo"
+WEREAD_REVIEW_LIST_URL = f"{WEREAD_API_URL}/review/list"
+WEREAD_BOOK_INFO = f"{WEREAD_API_URL}/book/info"
+WEREAD_READDATA_DETAIL = f"{WEREAD_API_URL}/readdata/detail"
+WEREAD_HISTORY_URL = f"{WEREAD_API_URL}/readdata/summary"
+WEREAD_SHELF_SYNC_URL = f"{WEREAD_API_URL}/shelf/sync"
+AUTH_ERRCODES = [-2012, -2010]
+REVIEW_LIST_SYNC = "review_list"
+CHAPTER_INFO_SYNC = "chapter_info"
+SHELF_SYNC = "shelf"
+HISTORY_SYNC = "read_summary"
+POOL_SIZE = int(os.getenv("WEREAD_POOL_SIZE", "16"))
+# Cookie fetched from CookieCloud, reused by later runs until it expires or WeRead rejects it
+COOKIE_CACHE = os.getenv("WEREAD_COOKIE_CACHE", "weread_cookie.json")
+COOKIE_CACHE_TTL = int(os.getenv("WEREAD_COOKIE_CACHE_TTL", str(12 * 3600)))
+CC_TIMEOUT = float(os.getenv("CC_TIMEOUT", "10"))
 
+# Set while a counted_retry method is on its second or later attempt
+attempt_state = threading.local()
 
-class WeReadApi:
-    def __init__(self):
-        self.cookie = self.get_cookie()
+
+def counted_retry(fn):
+    """@retry(stop_max_attempt_number=3, wait_fixed=5000) whose repeated attempts show as retries in metrics"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        attempts = []
+
+        @retry(stop_max_attempt_number=3, wait_fixed=5000)
+        def attempt():
+            attempt_state.retry = len(attempts) > 0
+            attempts.append(1)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                attempt_state.retry = False
+
+        return attempt()
+
+    return wrapper
+
+
+def replaying():
+    cassette = get_cassette()
+    return cassette is not None and cassette.replaying
+
+
+class WeReadTransport:
+    """Pooled keep-alive session that warms up weread.qq.com once and parses each response once"""
+
+    def __init__(self, cookies, pool_size=POOL_SIZE, renew=None):
         self.session = requests.Session()
-        self.session.cookies = self.parse_cookie_string()
+        self.session.cookies = cookies
+        cassette = get_cassette()
+        if cassette is not None:
+            adapter = CassetteAdapter(
+                cassette, "weread", pool_connections=4, pool_maxsize=pool_size
+            )
+        else:
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = threading.Lock()
+        self.generation = 0
+        # Called for new cookies when WeRead still rejects them after a warm-up
+        self.renew = renew
+        self.cookie_generation = 0
+
+    def warm_up(self, generation=None):
+        """Visit the WeRead home page once; pass the generation seen before an auth failure to re-warm"""
+        with self.lock:
+            if generation is None and self.generation > 0:
+                metrics.count("weread_saved_round_trips")
+                return self.generation
+            if generation is not None and generation != self.generation:
+                # Another thread already re-warmed after the same failure
+                return self.generation
+            self.send("GET", WEREAD_URL)
+            self.generation += 1
+            return self.generation
+
+    def request(self, method, url, **kwargs):
+        """Send a request and return the response with its parsed JSON body"""
+        generation = self.warm_up()
+        cookie_generation = self.cookie_generation
+        r, data = self.send(method, url, **kwargs)
+        if data.get("errcode") in AUTH_ERRCODES:
+            self.warm_up(generation)
+            r, data = self.send(method, url, retry=True, **kwargs)
+        if data.get("errcode") in AUTH_ERRCODES and self.renew_cookies(cookie_generation):
+            self.warm_up()
+            r, data = self.send(method, url, retry=True, **kwargs)
+        return r, data
+
+    def renew_cookies(self, cookie_generation):
+        """Swap in new cookies once per rejection; False when there are none to try"""
+        with self.lock:
+            if cookie_generation != self.cookie_generation:
+                # Another thread already renewed them
+                return True
+            cookies = self.renew() if self.renew else None
+            if cookies is None:
+                return False
+            self.session.cookies = cookies
+            self.cookie_generation += 1
+            self.generation = 0
+            return True
+
+    def send(self, method, url, retry=False, **kwargs):
+        """Send one request, recording its latency, size and outcome in metrics"""
+        endpoint = endpoint_name(method, urlparse(url).path)
+        retry = retry or getattr(attempt_state, "retry", False)
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.record("weread", endpoint, time.perf_counter() - start, error=True, retry=retry)
+            raise
+        data = self.parse(r)
+        metrics.record(
+            "weread",
+            endpoint,
+            time.perf_counter() - start,
+            len(r.request.body or b"") + len(r.content),
+            error=not r.ok or bool(data.get("errcode")),
+            retry=retry,
+        )
+        return r, data
+
+    def parse(self, r):
+        try:
+            data = r.json()
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+
+class WeReadApi:
+    def __init__(self, state_store=None):
+        self.cookie = None
+        self.transport = None
+        self.state_store = state_store
+
+    def start(self):
+        """Resolve the cookie and open the session; does nothing once started"""
+        if self.transport is None:
+            self.cookie = self.get_cookie()
+            self.transport = WeReadTransport(
+                self.parse_cookie_string(), renew=self.renew_cookie
+            )
+        return self
+
+    @property
+    def session(self):
+        return self.transport.session
 
     def try_get_cloud_cookie(self, url, id, password):
         if url.endswith("/"):
@@ -33,7 +185,7 @@ class WeReadApi:
         req_url = f"{url}/get/{id}"
         data = {"password": password}
         result = None
-        response = requests.post(req_url, data=data)
+        response = requests.post(req_url, data=data, timeout=CC_TIMEOUT)
         if response.status_code == 200:
             data = response.json()
             cookie_data = data.get("cookie_data")
@@ -46,16 +198,54 @@ class WeReadApi:
         return result
 
     def get_cookie(self):
+        if replaying():
+            # Replayed responses do not depend on the cookie, and CookieCloud must not be contacted
+            return os.getenv("WEREAD_COOKIE") or "wr_vid=replay"
         url = os.getenv("CC_URL", "https://cookiecloud.malinkang.com/")
         id = os.getenv("CC_ID")
         password = os.getenv("CC_PASSWORD")
-        cookie = os.getenv("WEREAD_COOKIE")
+        cookie = None
         if url and id and password:
-            cookie = self.try_get_cloud_cookie(url, id, password)
+            cookie = self.get_cloud_cookie(url, id, password)
+        if not cookie:
+            cookie = os.getenv("WEREAD_COOKIE")
         if not cookie or not cookie.strip():
             raise Exception("Cookie not found. Please follow the documentation to set it.")
         return cookie
 
+    def get_cloud_cookie(self, url, id, password, use_cache=True):
+        """CookieCloud cookie, from the local cache while it is fresh; it is validated by the first WeRead call"""
+        cache_key = hashlib.sha256(f"{url}{id}".encode()).hexdigest()
+        cached = load_cookie_cache(cache_key)
+        if use_cache and cached and time.time() - cached[1] < COOKIE_CACHE_TTL:
+            return cached[0]
+        try:
+            cookie = self.try_get_cloud_cookie(url, id, password)
+        except requests.RequestException as e:
+            print(f"CookieCloud is unavailable: {e}")
+            cookie = None
+        if cookie:
+            save_cookie_cache(cache_key, cookie)
+            return cookie
+        if cached:
+            print("Falling back to the cached CookieCloud cookie.")
+            return cached[0]
+        return None
+
+    def renew_cookie(self):
+        """Refetch the cookie from CookieCloud after WeRead rejected the current one"""
+        url = os.getenv("CC_URL", "https://cookiecloud.malinkang.com/")
+        id = os.getenv("CC_ID")
+        password = os.getenv("CC_PASSWORD")
+        if not (url and id and password) or replaying():
+            return None
+        cookie = self.get_cloud_cookie(url, id, password, use_cache=False)
+        if not cookie or cookie == self.cookie:
+            return None
+        print("WeRead rejected the cookie, using a new one from CookieCloud.")
+        self.cookie = cookie
+        return self.parse_cookie_string()
+
     def parse_cookie_string(self):
         cookies_dict = {}
         pattern = re.compile(r'([^=]+)=([^;]+);?\s*')
@@ -65,66 +255,68 @@ class WeReadApi:
         return cookiejar_from_dict(cookies_dict)
 
     def get_bookshelf(self):
-        self.session.get(WEREAD_URL)
-        r = self.session.get(
-            "https://i.weread.qq.com/shelf/sync?synckey=0&teenmode=0&album=1&onlyBookid=0"
+        synckey, cached = self.get_synced(SHELF_SYNC, "")
+        synckey, r, data = self.request_delta(
+            synckey,
+            lambda synckey: self.transport.request(
+                "GET",
+                WEREAD_SHELF_SYNC_URL,
+                params=dict(synckey=synckey, teenmode=0, album=1, onlyBookid=0),
+            ),
         )
         if r.ok:
-            return r.json()
+            shelf = merge_shelf(cached, data) if synckey else data
+            self.put_synced(SHELF_SYNC, "", data.get("synckey"), shelf)
+            return shelf
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get bookshelf {r.text}")
 
     def handle_errcode(self, errcode):
-        if errcode in [-2012, -2010]:
+        if errcode in AUTH_ERRCODES:
             print("::error::WeRead cookie expired. Please reset it as per the documentation.")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @counted_retry
     def get_notebooklist(self):
         """Get the list of notebooks."""
-        self.session.get(WEREAD_URL)
-        r = self.session.get(WEREAD_NOTEBOOKS_URL)
+        r, data = self.transport.request("GET", WEREAD_NOTEBOOKS_URL)
         if r.ok:
-            data = r.json()
             books = data.get("books", [])
             books.sort(key=lambda x: x["sort"])
             return books
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get notebook list {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @counted_retry
     def get_bookinfo(self, bookId):
         """Get details of a book."""
-        self.session.get(WEREAD_URL)
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOK_INFO, params=params)
+        r, data = self.transport.request("GET", WEREAD_BOOK_INFO, params=params)
         if r.ok:
-            return r.json()
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             print(f"Could not get book info {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @counted_retry
     def get_bookmark_list(self, bookId):
-        self.session.get(WEREAD_URL)
         params = dict(bookId=bookId)
-        r = self.session.get(WEREAD_BOOKMARKLIST_URL, params=params)
+        r, data = self.transport.request("GET", WEREAD_BOOKMARKLIST_URL, params=params)
         if r.ok:
             with open("bookmark.json", "w") as f:
-                f.write(json.dumps(r.json(), indent=4, ensure_ascii=False))
-            return r.json().get("updated")
+                f.write(json.dumps(data, indent=4, ensure_ascii=False))
+            return data.get("updated")
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Could not get {bookId} bookmark list")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @counted_retry
     def get_read_info(self, bookId):
-        self.session.get(WEREAD_URL)
         params = dict(
             noteCount=1,
             readingDetail=1,
@@ -142,54 +334,111 @@ class WeReadApi:
             "osver": "12",
             "User-Agent": "WeRead/8.2.5 WRBrand/xiaomi Dalvik/2.1.0 (Linux; U; Android 12; Redmi Note 7 Pro Build/SQ3A.220705.004)",
         }
-        r = self.session.get(WEREAD_READ_INFO_URL, headers=headers, params=params)
+        r, data = self.transport.request(
+            "GET", WEREAD_READ_INFO_URL, headers=headers, params=params
+        )
         if r.ok:
-            return r.json()
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Get {bookId} read info failed {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    def get_synced(self, kind, key):
+        """Return (synckey, items) saved by the last sync of a delta endpoint"""
+        if self.state_store is None:
+            return 0, None
+        return self.state_store.get_sync(kind, key) or (0, None)
+
+    def put_synced(self, kind, key, synckey, items):
+        if self.state_store is not None:
+            self.state_store.put_sync(kind, key, synckey or 0, items)
+
+    def request_delta(self, synckey, send):
+        """Send a delta request, falling back to a full fetch when the server rejects the sync key"""
+        r, data = send(synckey)
+        if synckey and (not r.ok or data.get("errcode")):
+            print(f"Sync key {synckey} rejected, falling back to a full fetch.")
+            synckey = 0
+            r, data = send(synckey)
+        return synckey, r, data
+
+    @counted_retry
     def get_review_list(self, bookId):
-        self.session.get(WEREAD_URL)
-        params = dict(bookId=bookId, listType=11, mine=1, syncKey=0)
-        r = self.session.get(WEREAD_REVIEW_LIST_URL, params=params)
+        synckey, cached = self.get_synced(REVIEW_LIST_SYNC, bookId)
+        synckey, r, data = self.request_delta(
+            synckey,
+            lambda synckey: self.transport.request(
+                "GET",
+                WEREAD_REVIEW_LIST_URL,
+                params=dict(bookId=bookId, listType=11, mine=1, syncKey=synckey),
+            ),
+        )
         if r.ok:
-            reviews = r.json().get("reviews")
-            reviews = list(map(lambda x: x.get("review"), reviews))
+            reviews = {x.get("reviewId"): x for x in cached} if synckey else {}
+            for x in data.get("reviews") or []:
+                review = x.get("review")
+                reviews[review.get("reviewId")] = review
+            for x in data.get("removed") or []:
+                reviews.pop(x.get("reviewId") if isinstance(x, dict) else x, None)
+            reviews = list(reviews.values())
+            self.put_synced(REVIEW_LIST_SYNC, bookId, data.get("synckey"), reviews)
             reviews = [
                 {"chapterUid": 1000000, **x} if x.get("type") == 4 else x
                 for x in reviews
             ]
             return reviews
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Get {bookId} review list failed {r.text}")
 
     def get_api_data(self):
-        self.session.get(WEREAD_URL)
-        r = self.session.get(WEREAD_HISTORY_URL)
+        synckey, cached = self.get_synced(HISTORY_SYNC, "")
+        synckey, r, data = self.request_delta(
+            synckey,
+            lambda synckey: self.transport.request(
+                "GET", WEREAD_HISTORY_URL, params=dict(synckey=synckey)
+            ),
+        )
         if r.ok:
-            return r.json()
+            if synckey:
+                read_times = cached.get("readTimes") or {}
+                read_times = {**read_times, **(data.get("readTimes") or {})}
+                data = {**cached, **data, "readTimes": read_times}
+            self.put_synced(HISTORY_SYNC, "", data.get("synckey"), data)
+            return data
         else:
-            errcode = r.json().get("errcode", 0)
+            errcode = data.get("errcode", 0)
             self.handle_errcode(errcode)
             raise Exception(f"Get history data failed {r.text}")
 
-    @retry(stop_max_attempt_number=3, wait_fixed=5000)
+    @counted_retry
     def get_chapter_info(self, bookId):
-        self.session.get(WEREAD_URL)
-        body = {"bookIds": [bookId], "synckeys": [0], "teenmode": 0}
-        r = self.session.post(WEREAD_CHAPTER_INFO, json=body)
+        synckey, cached = self.get_synced(CHAPTER_INFO_SYNC, bookId)
+        synckey, r, data = self.request_delta(
+            synckey,
+            lambda synckey: self.transport.request(
+                "POST",
+                WEREAD_CHAPTER_INFO,
+                json={"bookIds": [bookId], "synckeys": [synckey], "teenmode": 0},
+            ),
+        )
         if (
             r.ok
-            and "data" in r.json()
-            and len(r.json()["data"]) == 1
-            and "updated" in r.json()["data"][0]
+            and "data" in data
+            and len(data["data"]) == 1
+            and (synckey or "updated" in data["data"][0])
         ):
-            update = r.json()["data"][0]["updated"]
+            chapters = {x["chapterUid"]: x for x in cached} if synckey else {}
+            for x in data["data"][0].get("updated") or []:
+                chapters[x["chapterUid"]] = x
+            for x in data["data"][0].get("removed") or []:
+                chapters.pop(x.get("chapterUid") if isinstance(x, dict) else x, None)
+            update = list(chapters.values())
+            self.put_synced(
+                CHAPTER_INFO_SYNC, bookId, data["data"][0].get("synckey"), update
+            )
             update.append(
                 {
                     "chapterUid": 1000000,
@@ -245,3 +494,51 @@ class WeReadApi:
 
     def get_url(self, book_id):
         return f"https://weread.qq.com/web/reader/{self.calculate_book_str_id(book_id)}"
+
+
+def merge_by_book_id(cached, updated, removed):
+    books = {x.get("bookId"): x for x in cached}
+    for x in updated:
+        books[x.get("bookId")] = x
+    for book_id in removed:
+        books.pop(book_id, None)
+    return list(books.values())
+
+
+def merge_shelf(cached, delta):
+    """Apply a shelf/sync delta to the shelf saved by the previous run"""
+    removed = [
+        x.get("bookId") if isinstance(x, dict) else x
+        for x in delta.get("removed") or []
+    ]
+    shelf = {**cached, **delta}
+    for key in ["books", "bookProgress"]:
+        shelf[key] = merge_by_book_id(
+            cached.get(key) or [], delta.get(key) or [], removed
+        )
+    if not delta.get("archive"):
+        shelf["archive"] = cached.get("archive") or []
+    return shelf
+
+
+def load_cookie_cache(cache_key):
+    """Return (cookie, fetched_at) cached for this CookieCloud account, or None"""
+    if not COOKIE_CACHE or not os.path.exists(COOKIE_CACHE):
+        return None
+    try:
+        with open(COOKIE_CACHE) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get("key") != cache_key or not cache.get("cookie"):
+        return None
+    return cache.get("cookie"), cache.get("fetched_at", 0)
+
+
+def save_cookie_cache(cache_key, cookie):
+    if not COOKIE_CACHE:
+        return
+    # The cookie is a credential, keep the file private
+    fd = os.open(COOKIE_CACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump({"key": cache_key, "cookie": cookie, "fetched_at": time.time()}, f)